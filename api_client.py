@@ -1,63 +1,419 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
 import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+import metrics
+from image_codec import UPLOAD_CONTENT_TYPES, encode_image
+from key_pool import KeyPool
+
+DEFAULT_BASE_URL = "https://api.stability.ai"
+# Status codes worth another attempt: throttling and transient upstream failures
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class GenerationResult:
+    # Response of a generation call. The body is streamed into a spool that stays in
+    # memory up to spool_threshold bytes and moves to a temporary file beyond that; the
+    # image is decoded lazily, once, on first access.
+    def __init__(self, status_code, headers, body, size):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.size = size
+        self._content = None
+        self._image = None
+
+    @classmethod
+    def from_response(cls, response, spool_threshold, chunk_size=64 * 1024):
+        body = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        size = 0
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                body.write(chunk)
+                size += len(chunk)
+        finally:
+            response.close()
+        body.seek(0)
+        return cls(response.status_code, response.headers, body, size)
+
+    @classmethod
+    def from_bytes(cls, content, status_code=200, headers=None):
+        body = tempfile.SpooledTemporaryFile()
+        body.write(content)
+        body.seek(0)
+        result = cls(status_code, headers or {}, body, len(content))
+        result._content = content
+        return result
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        # Materialised only for callers that need raw bytes, e.g. error messages
+        if self._content is None:
+            self.body.seek(0)
+            self._content = self.body.read()
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    @property
+    def image(self):
+        if self._image is None:
+            self.body.seek(0)
+            image = Image.open(self.body)
+            image.load()
+            self._image = image
+        return self._image
+
+    def write_to(self, file):
+        self.body.seek(0)
+        shutil.copyfileobj(self.body, file)
+
+    def close(self):
+        self.body.close()
+
+
+class _Flight:
+    # One upstream call that concurrent identical requests wait on
+    def __init__(self):
+        self.event = threading.Event()
+        self.waiters = 0
+        self.status_code = None
+        self.headers = None
+        self.content = None
+        self.error = None
+
+
+def request_key(path, data, files):
+    # Content hash of everything that determines a result: endpoint, form fields
+    # (prompt, negative prompt, seed, ...) and the uploaded image/mask bytes
+    digest = hashlib.sha256()
+    digest.update(path.encode())
+    digest.update(json.dumps(data, sort_keys=True, default=str).encode())
+    for name in sorted(files):
+        digest.update(name.encode())
+        digest.update(files[name][1])
+    return digest.hexdigest()
+
 
 class StabilityAIClient:
-    def __init__(self, api_key):
-        self.api_key = api_key.strip()
+    def __init__(self, api_key, base_url=DEFAULT_BASE_URL, pool_size=10, timeout=(5, 120),
+                 max_retries=3, backoff_factor=0.5, max_backoff=30, upload_format="png",
+                 png_compress_level=1, jpeg_quality=95, cache=None, metrics_registry=None,
+                 spool_threshold=8 * 1024 * 1024, coalesce=True, key_cooldown=30):
+        # api_key is one key, several (a list or comma-separated string) or a KeyPool;
+        # requests are spread over all of them
+        self.key_pool = api_key if isinstance(api_key, KeyPool) else KeyPool(api_key, cooldown=key_cooldown)
+        # The first key doubles as the client's identity, e.g. for rate limiting
+        self.api_key = self.key_pool.keys[0]
+        self.base_url = base_url.rstrip("/")
+        # (connect, read) timeout in seconds, used unless a call passes its own
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        if upload_format not in UPLOAD_CONTENT_TYPES:
+            raise ValueError(f"Unsupported upload format: {upload_format}")
+        self.upload_format = upload_format
+        self.png_compress_level = png_compress_level
+        self.jpeg_quality = jpeg_quality
+        # Optional ResultCache; successful responses to requests with an explicit seed are
+        # stored keyed on request_key(). Unseeded ones are sampled afresh on every call.
+        self.cache = cache
+        self.metrics = metrics_registry or metrics.registry
+        # Response bodies larger than this are spooled to a temporary file
+        self.spool_threshold = spool_threshold
+        # Identical concurrent requests share one upstream call (single-flight)
+        self.coalesce = coalesce
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._closed = threading.Event()
+        # Authorization is set per request, from the key pool
         self.headers = {
             "Accept": "image/*",
-            "Authorization": f"Bearer {self.api_key}"
         }
 
-    def inpaint_image(self, prompt, negative_prompt, image_path, mask_path, output_format="png"):
-        url = "https://api.stability.ai/v2beta/stable-image/edit/inpaint"
+        # One pooled session per client so generations reuse keep-alive connections
+        # instead of paying a fresh TCP+TLS handshake on every call
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        self._closed.set()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def key_stats(self):
+        # Per-key load, throttling and throughput, for dashboards and capacity planning
+        return self.key_pool.stats()
+
+    def get_balance(self, api_key=None):
+        # Remaining credits of one account
+        response = self.session.get(
+            f"{self.base_url}/v1/user/balance",
+            headers={"Accept": "application/json", "Authorization": f"Bearer {api_key or self.api_key}"},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()["credits"]
+
+    def refresh_credits(self):
+        # Keys at or below the pool's minimum are taken out of rotation until refreshed again
+        for key in self.key_pool.keys:
+            try:
+                credits = self.get_balance(key)
+            except (requests.RequestException, KeyError, ValueError):
+                continue
+            self.key_pool.set_credits(key, credits)
+            self.metrics.set("stability_key_credits", credits, key=self.key_pool.label(key))
+
+    def start_credit_refresh(self, interval):
+        # Refresh every key's balance now and then every `interval` seconds on a daemon
+        # thread, until the client is closed
+        def loop():
+            while not self._closed.is_set():
+                self.refresh_credits()
+                self._closed.wait(interval)
+
+        thread = threading.Thread(target=loop, name="credit-refresh", daemon=True)
+        thread.start()
+        return thread
+
+    def encode(self, image):
+        # Encode once with the client's upload settings, e.g. to share one upload
+        # across several calls
+        return encode_image(image, self.upload_format, self.png_compress_level, self.jpeg_quality)
+
+    def _upload_part(self, name, source, image_format=None):
+        # Build an in-memory multipart part from a PIL image, raw encoded bytes
+        # (bytes/bytearray/memoryview) or a file path, without touching disk for the first two
+        if isinstance(source, Image.Image):
+            image_format = image_format or self.upload_format
+            with self.metrics.stage("upload_encode"):
+                data = encode_image(source, image_format, self.png_compress_level, self.jpeg_quality)
+            return (f"{name}.{image_format}", data, UPLOAD_CONTENT_TYPES[image_format])
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return (name, source, "application/octet-stream")
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as file:
+                return (os.path.basename(source), file.read(), "application/octet-stream")
+        raise TypeError(f"Unsupported {name} type: {type(source).__name__}")
+
+    def _backoff_delay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+
+    def _retry_after_delay(self, response):
+        # Retry-After is either a number of seconds or an HTTP date
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        return min(max(delay, 0), self.max_backoff)
+
+    def _post(self, path, files, data, timeout=None):
+        endpoint = path.rsplit("/", 1)[-1]
+        if self.cache is None and not self.coalesce:
+            return self._send(path, endpoint, files, data, timeout)
+        key = request_key(path, data, files)
+        # Without a seed the same request is expected to give a new image each time
+        cache = self.cache if "seed" in data else None
+        if cache is not None:
+            content = cache.get(key)
+            if content is not None:
+                self.metrics.inc("stability_cache_requests_total", endpoint=endpoint, result="hit")
+                return GenerationResult.from_bytes(content)
+            self.metrics.inc("stability_cache_requests_total", endpoint=endpoint, result="miss")
+        if not self.coalesce:
+            return self._fetch(key, path, endpoint, files, data, timeout, cache)
+
+        with self._inflight_lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                flight.waiters += 1
+        if not leader:
+            self.metrics.inc("stability_coalesced_requests_total", endpoint=endpoint)
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return GenerationResult.from_bytes(flight.content, flight.status_code, flight.headers)
+
+        try:
+            result = self._fetch(key, path, endpoint, files, data, timeout, cache)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            # No one can join once the flight is unregistered, so waiters is final here
+            if flight.error is None and flight.waiters:
+                flight.status_code = result.status_code
+                flight.headers = result.headers
+                flight.content = result.content
+            flight.event.set()
+        return result
+
+    def _fetch(self, key, path, endpoint, files, data, timeout, cache=None):
+        result = self._send(path, endpoint, files, data, timeout)
+        if cache is not None and result.status_code == 200:
+            result.body.seek(0)
+            cache.put(key, result.body)
+        return result
+
+    def _send(self, path, endpoint, files, data, timeout=None):
+        url = f"{self.base_url}{path}"
+        self.metrics.inc(
+            "stability_bytes_sent_total", sum(len(part[1]) for part in files.values()), endpoint=endpoint)
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            # Every attempt picks a key, so a retry after a 429 or 402 goes to another account
+            api_key = self.key_pool.acquire()
+            key_label = self.key_pool.label(api_key)
+            attempt_started = time.perf_counter()
+            try:
+                response = self.session.post(
+                    url, files=files, data=data, headers={"Authorization": f"Bearer {api_key}"},
+                    timeout=timeout or self.timeout, stream=True)
+            except BaseException as e:
+                self.key_pool.release(api_key, None, time.perf_counter() - attempt_started)
+                if not isinstance(e, requests.ConnectionError):
+                    raise
+                # Covers connect timeouts too; read timeouts are not retried so a
+                # slow upstream call can't hold the caller for several timeouts in a row
+                self.metrics.inc("stability_responses_total", endpoint=endpoint, status="connection_error")
+                self.metrics.inc("stability_key_requests_total", key=key_label, status="connection_error")
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff_delay(attempt)
+            else:
+                status = response.status_code
+                self.metrics.inc("stability_responses_total", endpoint=endpoint, status=str(status))
+                self.metrics.inc("stability_key_requests_total", key=key_label, status=str(status))
+                released = False
+                if status == 402 and attempt < self.max_retries:
+                    # This key is out of credits: release it first so it leaves rotation,
+                    # then retry on another key if one is left
+                    self.key_pool.release(api_key, status, time.perf_counter() - attempt_started)
+                    released = True
+                retry = status in RETRY_STATUS_CODES or (released and self.key_pool.available())
+                if not retry or attempt >= self.max_retries:
+                    try:
+                        result = GenerationResult.from_response(response, self.spool_threshold)
+                    finally:
+                        if not released:
+                            self.key_pool.release(api_key, status, time.perf_counter() - attempt_started)
+                    # Latency covers every attempt and backoff, as seen by the caller
+                    self.metrics.observe(
+                        "stability_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+                    self.metrics.inc("stability_bytes_received_total", result.size, endpoint=endpoint)
+                    return result
+                if released:
+                    # A 402 with another key still in rotation: retry on it right away
+                    delay = 0
+                else:
+                    retry_after = self._retry_after_delay(response)
+                    self.key_pool.release(api_key, status, time.perf_counter() - attempt_started, retry_after)
+                    if status == 429 and self.key_pool.available():
+                        # Another key is still in rotation: retry on it right away
+                        delay = 0
+                    else:
+                        delay = retry_after if retry_after is not None else self._backoff_delay(attempt)
+                response.close()
+
+            attempt += 1
+            self.metrics.inc("stability_retries_total", endpoint=endpoint)
+            time.sleep(delay)
+
+    def inpaint_image(self, prompt, negative_prompt, image, mask, output_format="png", seed=None, grow_mask=1,
+                      timeout=None):
         files = {
-            "image": open(image_path, "rb"),
-            "mask": open(mask_path, "rb"),
+            "image": self._upload_part("image", image),
+            # Masks are always sent as lossless PNG
+            "mask": self._upload_part("mask", mask, image_format="png"),
         }
         data = {
             "prompt": prompt,
-            "grow_mask": 1,
+            "grow_mask": grow_mask,
             "output_format": output_format,
         }
         if negative_prompt:
             data["negative_prompt"] = negative_prompt
-        response = requests.post(url, headers=self.headers, files=files, data=data)
-        return response
-
-    def search_and_replace_image(self, prompt, negative_prompt, image_path):
-        url = "https://api.stability.ai/v2beta/stable-image/edit/search-and-replace"
-        with open(image_path, "rb") as image_file:
-            files = {
-                "image": image_file
-            }
-            data = {
-                "prompt": prompt,
-                "search_prompt": "floor and white walls",
-                "negative_prompt": negative_prompt,
-                "output_format": "jpeg",
-                "seed": 1
-            }
-            response = requests.post(url, headers=self.headers, files=files, data=data)
-        return response
-    
-    def structure_image(self, prompt, negative_prompt, image_path,  output_format="png"):
-        url = "https://api.stability.ai/v2beta/stable-image/control/structure"
+        if seed is not None:
+            data["seed"] = seed
+        result = self._post("/v2beta/stable-image/edit/inpaint", files, data, timeout)
+        return result
 
+    def search_and_replace_image(self, prompt, negative_prompt, image, timeout=None):
         files = {
-            "image": open(image_path, "rb"),
+            "image": self._upload_part("image", image)
+        }
+        data = {
+            "prompt": prompt,
+            "search_prompt": "floor and white walls",
+            "negative_prompt": negative_prompt,
+            "output_format": "jpeg",
+            "seed": 1
+        }
+        result = self._post("/v2beta/stable-image/edit/search-and-replace", files, data, timeout)
+        return result
+
+    def structure_image(self, prompt, negative_prompt, image, output_format="png", seed=None, timeout=None):
+        files = {
+            "image": self._upload_part("image", image),
         }
         data = {
             "prompt": prompt,
             "negative_prompt": negative_prompt,
             "output_format": output_format,
         }
-        response = requests.post(url, headers=self.headers, files=files, data=data)
-        return response
-    def erase_image(self, prompt, negative_prompt, image_path, mask_path, output_format="png"):
-        url = "https://api.stability.ai/v2beta/stable-image/edit/erase"
+        if seed is not None:
+            data["seed"] = seed
+        result = self._post("/v2beta/stable-image/control/structure", files, data, timeout)
+        return result
+
+    def erase_image(self, prompt, negative_prompt, image, mask, output_format="png", seed=None, grow_mask=None,
+                    timeout=None):
         files = {
-            "image": open(image_path, "rb"),
-            "mask": open(mask_path, "rb"),
+            "image": self._upload_part("image", image),
+            "mask": self._upload_part("mask", mask, image_format="png"),
         }
         data = {
             "prompt": prompt,
@@ -65,5 +421,9 @@ class StabilityAIClient:
         }
         if negative_prompt:
             data["negative_prompt"] = negative_prompt
-        response = requests.post(url, headers=self.headers, files=files, data=data)
-        return response
\ No newline at end of file
+        if seed is not None:
+            data["seed"] = seed
+        if grow_mask is not None:
+            data["grow_mask"] = grow_mask
+        result = self._post("/v2beta/stable-image/edit/erase", files, data, timeout)
+        return result
@@ -1,52 +1,328 @@
 import os
 import streamlit as st
-from streamlit_drawable_canvas import st_canvas
-from PIL import Image
 from dotenv import load_dotenv
-from datetime import datetime
-import tempfile
-from io import BytesIO
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
 
-from image_processing import create_mask_from_canvas
-from api_client import StabilityAIClient
-from prompts import item_prompts
+from image_processing import build_mask_from_canvas, load_image, crop_to_mask, downscale_for_preview, generate_region
+from image_codec import encode_image
+from job_queue import JobExecutor, RateLimiter, QUEUED, DONE, FAILED
+from history_store import HistoryStore, MemoryBudget, Snapshot
+from prefetch import PrefetchRegion, SelectionCounts, prefetch_region
+from session_store import BlobStore, ImageCache, SQLiteSessionBackend, schedule_garbage_collection
+from metrics import registry as metrics
 
-# Load environment variables from .env file
-load_dotenv()
+
+# No spinner: this runs before st.set_page_config, which must be the first element
+@st.cache_resource(show_spinner=False)
+def load_environment():
+    # Load environment variables from .env file, once per server process
+    load_dotenv()
+
+
+load_environment()
 
 # Retrieve the API key from environment variables
 API_KEY = st.secrets["STABILITY_AI"]
+# Seconds between reruns while a generation job is running
+JOB_POLL_INTERVAL = 1.0
+# Server-wide metrics are for operators: written to METRICS_TEXTFILE if set, and shown
+# in the sidebar only with SHOW_METRICS=1, since they cover every session's traffic and keys
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE")
+SHOW_METRICS = os.getenv("SHOW_METRICS") == "1"
+# Seconds between balance checks of the API keys
+CREDIT_REFRESH_INTERVAL = 300
+# Layout of the batch variant grid and the largest seed offset a batch can use
+BATCH_GRID_COLUMNS = 3
+MAX_BATCH_SEEDS = 8
+# Byte budgets for compressed undo/redo snapshots, per session and per server process
+SESSION_HISTORY_BYTES = 200 * 1024 * 1024
+SERVER_HISTORY_BYTES = 2 * 1024 * 1024 * 1024
+# Undo steps kept per session; snapshots themselves live in the blob store
+MAX_HISTORY_STEPS = 50
+# Decoded images kept in memory per server process, across all sessions
+IMAGE_CACHE_BYTES = 512 * 1024 * 1024
+# Archived masks, content-addressed and pruned least-recently-used first
+MASK_DIR = "saved_masks"
+MASK_STORE_BYTES = 256 * 1024 * 1024
+# Accepted generations, stored full resolution under their content hash with a thumbnail
+# (longest side in pixels) and a WebP copy; set either to None to skip it
+RESULTS_DIR = "results"
+RESULT_THUMBNAIL_SIZE = 256
+RESULT_WEBP_QUALITY = 85
+# Persistent session state and content-addressed image blobs. Sessions not saved for
+# SESSION_TTL seconds are expired, and blobs no session refers to are removed, every
+# SESSION_GC_INTERVAL seconds
+SESSION_DIR = "sessions"
+SESSION_TTL = 7 * 24 * 3600
+SESSION_GC_INTERVAL = 3600
+# Uploads are kept at full resolution up to the endpoints' limit (~9.4 MP) and results are
+# composited back into that; only the cropped region sent upstream is downscaled, to at
+# most this many pixels
+MAX_UPLOAD_PIXELS = 4 * 1024 * 1024
+# Generation modes: straight to full resolution, or a fast low-resolution preview first
+# with the full-resolution call made on accept or speculatively in the background
+PREVIEW_OFF = "Full resolution only"
+PREVIEW_ON_ACCEPT = "Preview first, full resolution on accept"
+PREVIEW_SPECULATIVE = "Preview first, full resolution in the background"
+PREVIEW_MODES = [PREVIEW_OFF, PREVIEW_ON_ACCEPT, PREVIEW_SPECULATIVE]
+# Opt-in prefetching of the most selected items once a mask is drawn: how many items,
+# how long the strokes must stay unchanged first, and the spend caps (calls per hour)
+PREFETCH_ITEMS = 3
+PREFETCH_DELAY = 1.5
+PREFETCH_SESSION_CALLS_PER_HOUR = 12
+PREFETCH_SERVER_CALLS_PER_HOUR = 300
+# Speculative jobs get their own small pool so they never hold a generation worker
+PREFETCH_WORKERS = 3
+# Item prompt catalogue (JSON or SQLite, reloaded when the file changes) and how many
+# matches the item pickers list at once
+PROMPT_CATALOGUE = os.getenv("PROMPT_CATALOGUE", "catalogue/prompts.json")
+MAX_ITEM_OPTIONS = 200
 # Set the app to wide mode
 st.set_page_config(layout="wide")
 
 
-def load_css():
+@st.cache_data
+def read_css():
     with open("style.css") as f:
-        st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+        return f.read()
+
+
+@st.cache_data
+def read_logo():
+    with open("assets/logo_KRK.png", "rb") as f:
+        return f.read()
+
+
+def load_css():
+    # The file is read once; the style tag still has to be sent on every run
+    st.markdown(f"<style>{read_css()}</style>", unsafe_allow_html=True)
 
 
 # Call this function at the beginning of your app
 load_css()
 
 
+@st.cache_resource
+def get_item_prompts():
+    # The prompt catalogue, shared by every session. It loads and indexes the file on first
+    # use and picks up edits by itself, so no server restart is needed.
+    from prompt_catalogue import PromptCatalogue
+    return PromptCatalogue(PROMPT_CATALOGUE)
+
+
+@st.cache_resource
+def get_api_client(api_key):
+    # Shared across sessions and reruns so the pooled keep-alive connections survive.
+    # Imported here so pages that never call the API don't load the client or scan the cache.
+    from api_client import StabilityAIClient
+    from result_cache import ResultCache
+
+    cache = ResultCache(os.path.join("cache", "results"), max_bytes=1024 * 1024 * 1024)
+    client = StabilityAIClient(api_key, cache=cache)
+    # Keeps the key pool's view of each account's credits current
+    client.start_credit_refresh(CREDIT_REFRESH_INTERVAL)
+    return client
+
+
+@st.cache_resource
+def get_mask_store():
+    # Identical masks (same strokes, or the same mask from another user) are stored once
+    from result_cache import ResultCache
+    return ResultCache(MASK_DIR, max_bytes=MASK_STORE_BYTES)
+
+
+@st.cache_resource
+def get_selection_counts():
+    # Server-wide item popularity, used to rank what to prefetch
+    return SelectionCounts(os.path.join(SESSION_DIR, "item_selections.json"))
+
+
+@st.cache_resource
+def get_prefetch_budget():
+    # Spend cap for speculative calls across every session
+    return RateLimiter(PREFETCH_SERVER_CALLS_PER_HOUR / 3600, burst=PREFETCH_SERVER_CALLS_PER_HOUR)
+
+
+@st.cache_resource
+def get_job_executor():
+    # One executor per server process, shared by every session
+    return JobExecutor(max_workers=8, requests_per_second=10)
+
+
+@st.cache_resource
+def get_prefetch_executor():
+    # Spend is capped by the prefetch budgets rather than a per-key rate limiter, which
+    # would take a token before the delay even for jobs that end up cancelled
+    return JobExecutor(max_workers=PREFETCH_WORKERS, requests_per_second=None, name="prefetch")
+
+
+@st.cache_resource
+def start_metrics_export():
+    # One writer thread per server process
+    return metrics.export_textfile(METRICS_TEXTFILE) if METRICS_TEXTFILE else None
+
+
+@st.cache_resource
+def get_session_backend():
+    # Swap in another SessionBackend (e.g. on shared storage) to run several replicas
+    return SQLiteSessionBackend(os.path.join(SESSION_DIR, "sessions.sqlite3"))
+
+
+@st.cache_resource
+def get_blob_store():
+    return BlobStore(os.path.join(SESSION_DIR, "blobs"))
+
+
+@st.cache_resource
+def start_session_gc():
+    # One collector thread per server process
+    return schedule_garbage_collection(get_session_backend(), get_blob_store(), SESSION_GC_INTERVAL, SESSION_TTL)
+
+
+@st.cache_resource
+def get_image_cache():
+    return ImageCache(IMAGE_CACHE_BYTES)
+
+
+@st.cache_resource
+def get_result_writer():
+    from result_writer import ResultWriter
+    return ResultWriter(RESULTS_DIR, thumbnail_size=RESULT_THUMBNAIL_SIZE, webp_quality=RESULT_WEBP_QUALITY)
+
+
+# Download payloads by digest. cache_resource hands back the same bytes object on every
+# rerun (cache_data would copy it), so poll reruns neither read the file nor copy it.
+@st.cache_resource(max_entries=8, show_spinner=False)
+def read_snapshot_bytes(digest):
+    return get_blob_store().get(digest)
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def read_result_bytes(digest, kind):
+    return get_result_writer().read(digest, kind)
+
+
+@st.cache_resource
+def get_history_budget():
+    # Shared by every session's history so the server as a whole stays within budget
+    return MemoryBudget(SERVER_HISTORY_BYTES)
+
+
 class InteractiveImageApp:
     def __init__(self, api_key):
-        self.api_client = StabilityAIClient(api_key)
+        self.api_key = api_key
+        self._api_client = None
+        self.executor = get_job_executor()
+        self.session_backend = get_session_backend()
+        start_session_gc()
+        start_metrics_export()
+        self.image_cache = get_image_cache()
+        self.session_id = self.resolve_session_id()
         self.initialize_session_state()
-        self.setup_sidebar()
-        self.setup_results_directory()  # Set up the results directory
+        self.restore_session()
+        self.result_writer = get_result_writer()
+        self.canvas_result = None  # Set once the canvas is drawn
+        self.poll_pending = False  # Set when the run ends to poll a job again
+
+    @property
+    def api_client(self):
+        # Created on first use; the upload page renders without it
+        if self._api_client is None:
+            self._api_client = get_api_client(self.api_key)
+        return self._api_client
+
+    @property
+    def item_prompts(self):
+        return get_item_prompts()
+
+    @property
+    def current_image(self):
+        # Decoded from the current snapshot on demand; shared across reruns by the image cache
+        if st.session_state.current_snapshot is None:
+            return None
+        return self.image_cache.get(st.session_state.current_snapshot)
+
+    def set_current_image(self, image):
+        st.session_state.current_snapshot = st.session_state.image_history.snapshot(image)
+
+    def resolve_session_id(self):
+        # The session id lives in the URL, so a reload, a restarted pod or another replica
+        # behind the load balancer picks up the same persisted state
+        query_params = st.experimental_get_query_params()
+        # Backends use the id as a key or file name, so only ids we could have issued count
+        if "session" in query_params and re.fullmatch(r"[0-9a-f]{32}", query_params["session"][0]):
+            return query_params["session"][0]
+        session_id = uuid.uuid4().hex
+        st.experimental_set_query_params(session=session_id)
+        return session_id
+
+    def restore_session(self):
+        # Only once per browser session; later reruns use what is already in session state
+        if st.session_state.session_restored:
+            return
+        st.session_state.session_restored = True
+        state = self.session_backend.load(self.session_id)
+        if state is None:
+            return
+        blob_store = get_blob_store()
+        if state["current"] is not None and not blob_store.exists(state["current"][0]):
+            # The image was lost (e.g. garbage collected); start over rather than fail on every rerun
+            metrics.inc("session_restore_total", result="missing_blob")
+            return
+        if state["current"] is not None:
+            st.session_state.current_snapshot = Snapshot.from_state(state["current"], blob_store)
+        # Lost history steps are dropped; the rest can still be undone to
+        history = {name: [item for item in items if blob_store.exists(item[0])]
+                   for name, items in state["history"].items()}
+        st.session_state.image_history.load_state(history)
+        st.session_state.canvas_data = state["canvas_data"]
+        st.session_state.has_generated_image = state["has_generated_image"]
+        st.session_state.image_update_counter = state["image_update_counter"] + 1
+        st.session_state.persisted_state = state
+
+    def persist_session(self):
+        current = st.session_state.current_snapshot
+        history = st.session_state.image_history.to_state()
+        digests = [digest for digest, _ in history["undo"] + history["redo"]]
+        if current is not None:
+            digests.append(current.digest)
+        state = {
+            "current": current.to_state() if current is not None else None,
+            "history": history,
+            "canvas_data": st.session_state.canvas_data,
+            "has_generated_image": st.session_state.has_generated_image,
+            "image_update_counter": st.session_state.image_update_counter,
+            "digests": digests,
+        }
+        # Most reruns change nothing worth persisting
+        if state != st.session_state.persisted_state:
+            self.session_backend.save(self.session_id, state)
+            st.session_state.persisted_state = state
 
     def initialize_session_state(self):
-        if 'current_image' not in st.session_state:
-            st.session_state.current_image = None
+        if 'current_snapshot' not in st.session_state:
+            st.session_state.current_snapshot = None  # Compressed current image, decoded lazily
+        if 'session_restored' not in st.session_state:
+            st.session_state.session_restored = False
+        if 'persisted_state' not in st.session_state:
+            st.session_state.persisted_state = None
         if 'canvas_data' not in st.session_state:
             st.session_state.canvas_data = None
         if 'current_mask' not in st.session_state:
-            st.session_state.current_mask = None
+            st.session_state.current_mask = None  # Last built mask, reused while the strokes don't change
         if 'image_update_counter' not in st.session_state:
             st.session_state.image_update_counter = 0  # Initialize the counter
         if 'image_history' not in st.session_state:
-            st.session_state.image_history = []  # Initialize the history
+            # Undo/redo snapshots, compressed and bounded by the per-session and server budgets
+            st.session_state.image_history = HistoryStore(
+                max_bytes=SESSION_HISTORY_BYTES, budget=get_history_budget(),
+                blob_store=get_blob_store(), max_steps=MAX_HISTORY_STEPS)
         if 'has_generated_image' not in st.session_state:
             st.session_state.has_generated_image = False  # Track if generation has been made
         if 'action' not in st.session_state:
@@ -57,17 +333,44 @@ class InteractiveImageApp:
             st.session_state.bg_image_uploaded = None  # Keep track of the uploaded image
         if 'selected_item' not in st.session_state:
             st.session_state.selected_item = None  # Selected item from prompts
+        if 'generation_job' not in st.session_state:
+            st.session_state.generation_job = None  # Id and status of the in-flight generation
+        if 'batch_jobs' not in st.session_state:
+            st.session_state.batch_jobs = []  # Variants of the in-flight batch
+        if 'batch_items' not in st.session_state:
+            st.session_state.batch_items = []
+        if 'batch_seed_count' not in st.session_state:
+            st.session_state.batch_seed_count = 1
+        if 'batch_parallelism' not in st.session_state:
+            st.session_state.batch_parallelism = 4
+        if 'canvas_background' not in st.session_state:
+            st.session_state.canvas_background = None  # Encoded canvas preview of the current image
+        if 'mask_dilation' not in st.session_state:
+            st.session_state.mask_dilation = 0  # Mask growth in canvas pixels
+        if 'mask_feather' not in st.session_state:
+            st.session_state.mask_feather = 0  # Mask edge softening in canvas pixels
+        if 'preview_mode' not in st.session_state:
+            st.session_state.preview_mode = PREVIEW_OFF
+        if 'preview' not in st.session_state:
+            st.session_state.preview = None  # Low-resolution preview awaiting accept/discard
+        if 'prefetch_enabled' not in st.session_state:
+            st.session_state.prefetch_enabled = False
+        if 'prefetch' not in st.session_state:
+            st.session_state.prefetch = None  # Speculative item jobs for the current mask
+        if 'prefetch_budget' not in st.session_state:
+            st.session_state.prefetch_budget = RateLimiter(
+                PREFETCH_SESSION_CALLS_PER_HOUR / 3600, burst=PREFETCH_SESSION_CALLS_PER_HOUR)
 
     def setup_sidebar(self):
         with st.sidebar:
             # Add company image
             # Update the path
-            st.image("assets/logo_KRK.png", use_column_width=True)
+            st.image(read_logo(), use_column_width=True)
             st.markdown(
                 "<h2 style='color: var(--highlight-text-color2);'>PhotoShoot Options</h2>", unsafe_allow_html=True)
 
             # Show "Upload Image" or "Start New Photoshoot" based on the current state
-            if st.session_state.current_image is None:
+            if st.session_state.current_snapshot is None:
                 st.markdown(
                     "<h5 style='color: var(--highlight-text-color2);'>Upload the image here:</h5>", unsafe_allow_html=True)
                 # Upload image and save it in session state
@@ -80,136 +383,157 @@ class InteractiveImageApp:
                 # Show a "Start New Photoshoot" button
                 if st.button("Start New Photoshoot"):
                     # Reset all relevant session state variables
-                    st.session_state.current_image = None
+                    st.session_state.current_snapshot = None
                     st.session_state.canvas_data = None
                     st.session_state.current_mask = None
                     st.session_state.image_update_counter = 0
-                    st.session_state.image_history = []
+                    st.session_state.image_history.clear()
                     st.session_state.has_generated_image = False
                     st.session_state.action = "CompleteMakeOverAI"
                     st.session_state.selected_item = None
                     st.session_state.uploaded_image = None  # Reset uploaded image
-                    st.rerun()
+                    self.cancel_generation_job()
+                    self.cancel_batch_jobs()
+                    st.session_state.canvas_background = None
+                    if st.session_state.preview is not None:
+                        self.discard_preview("discarded")
+                    self.cancel_prefetch()
+                    st.experimental_rerun()
             # Add buttons for other functionalities if an image is uploaded
-            if st.session_state.current_image is not None:
+            if st.session_state.current_snapshot is not None:
                 # Separator for better organization
                 st.markdown("<hr>", unsafe_allow_html=True)
 
+                # Snapshot bytes held by the undo history, for sizing the deployment
+                budget = get_history_budget()
+                st.caption(
+                    f"History: {st.session_state.image_history.stored_bytes() / 2**20:.1f} MB "
+                    f"(server: {budget.total_bytes / 2**20:.1f} MB), "
+                    f"decoded images: {self.image_cache.total_bytes / 2**20:.1f} MB")
+
                 if st.button("Refresh Canvas"):
                     st.session_state.image_update_counter += 1
-                    st.rerun()
-                if st.session_state.image_history:
+                    st.experimental_rerun()
+                if st.session_state.image_history.can_undo:
                     if st.button("Undo Last Change"):
-                        # Push current image to redo stack
-                        if 'redo_stack' not in st.session_state:
-                            st.session_state.redo_stack = []
-                        st.session_state.redo_stack.append(
-                            st.session_state.current_image.copy())
-
-                        # Undo last change
+                        # Undo last change; the current image moves onto the redo stack
                         self.undo_last_change()
 
-                if 'redo_stack' in st.session_state and st.session_state.redo_stack:
+                if st.session_state.image_history.can_redo:
                     if st.button("Redo Last Change"):
-                        # Pop the last image from the redo stack
-                        redo_image = st.session_state.redo_stack.pop()
-
-                        # Push current image to the history
-                        st.session_state.image_history.append(
-                            st.session_state.current_image.copy())
-
-                        # Restore the redo image
-                        st.session_state.current_image = redo_image
+                        # Restore the redo image; the current image moves back into the history
+                        st.session_state.current_snapshot = st.session_state.image_history.redo(
+                            st.session_state.current_snapshot)
 
                         # Increment the image update counter to refresh the canvas
                         st.session_state.image_update_counter += 1
-                        st.rerun()
-                if st.button("Download Image"):
-                    if self.canvas_result and self.canvas_result.image_data is not None:
-                        # Convert canvas data to image
-                        canvas_image = Image.fromarray(
-                            self.canvas_result.image_data.astype('uint8'), 'RGBA')
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        save_path = f"canvas_image_{timestamp}.png"
-                        canvas_image.save(save_path)
-                        st.success(f"Image saved as {save_path}")
-
-    def setup_results_directory(self):
-        # Create the results directory if it doesn't exist
-        self.results_dir = "results"
-        os.makedirs(self.results_dir, exist_ok=True)
+                        st.experimental_rerun()
+                # The full-resolution image as stored, not the scaled canvas preview
+                snapshot = st.session_state.current_snapshot
+                image_format = st.session_state.image_history.image_format
+                st.download_button(
+                    "Download Image", read_snapshot_bytes(snapshot.digest),
+                    file_name=f"{snapshot.digest[:16]}.{image_format}", mime=f"image/{image_format}")
+                # Offered once the background writer has produced it
+                if os.path.exists(self.result_writer.path(snapshot.digest, "webp")):
+                    st.download_button(
+                        "Download WebP", read_result_bytes(snapshot.digest, "webp"),
+                        file_name=f"{snapshot.digest[:16]}.webp", mime="image/webp")
+
+    def show_metrics(self):
+        with st.sidebar.expander("Performance metrics"):
+            metrics_text = metrics.prometheus_text()
+            st.code(metrics_text, language="text")
+            st.download_button("Download metrics", metrics_text, file_name="metrics.prom")
+
+    def save_result(self):
+        # Queue the current image for results/; the snapshot is already encoded, so the
+        # stored file is byte-identical to it and nothing is encoded on this rerun
+        snapshot = st.session_state.current_snapshot
+        self.result_writer.submit(
+            snapshot.digest, snapshot.data, extension=st.session_state.image_history.image_format)
 
     def run(self):
+        self.setup_sidebar()
+        if SHOW_METRICS:
+            self.show_metrics()
         st.markdown(
             "<h1 style='color: var(--highlight-text-color);'>Furniture AI</h1>", unsafe_allow_html=True)
 
         # Handle image upload
         if 'uploaded_image' in st.session_state and st.session_state.uploaded_image:
             if st.session_state.bg_image_uploaded != st.session_state.uploaded_image:
-                # Open the uploaded image
-                uploaded_image = Image.open(
-                    st.session_state.uploaded_image).convert('RGB')
+                # Open the uploaded image, decoded at no more than the endpoints' limit
+                uploaded_image = load_image(st.session_state.uploaded_image)
                 # Update session state with the new image
-                st.session_state.current_image = uploaded_image.copy()
+                self.set_current_image(uploaded_image)
                 st.session_state.bg_image_uploaded = st.session_state.uploaded_image
                 # Reset the image update counter
                 st.session_state.image_update_counter += 1  # Increment to refresh canvas
                 # Clear any existing generated image and history
-                st.session_state.image_history = []
+                st.session_state.image_history.clear()
                 st.session_state.has_generated_image = False
                 # Rerun to refresh the canvas with the new image
-                st.rerun()
-        if st.session_state.current_image:
+                st.experimental_rerun()
+        if st.session_state.current_snapshot is not None:
             # Show the drawable canvas
             self.display_canvas()
             st.markdown(
                 "<h1 style='color: var(--highlight-text-color);'>Select Action:</h1>", unsafe_allow_html=True)
             self.select_action()
+            self.select_mask_options()
+            self.select_preview_mode()
             self.handle_image_generation()
         else:
             st.info("Please upload an image to start drawing!")
 
     def undo_last_change(self):
-        if st.session_state.image_history:
+        if st.session_state.image_history.can_undo:
             # Revert to the last image in history
-            st.session_state.current_image = st.session_state.image_history.pop()
+            st.session_state.current_snapshot = st.session_state.image_history.undo(
+                st.session_state.current_snapshot)
             st.session_state.image_update_counter += 1  # Increment counter
             # Clear the canvas data
             st.session_state.canvas_data = None
             # Rerun to update the canvas with the previous image
-            st.rerun()        
+            st.experimental_rerun()
         else:
             st.warning("No changes to undo.")
     def display_canvas(self):
         # Ensure there is a current image in session state
-        if st.session_state.current_image is None:
+        if st.session_state.current_snapshot is None:
             st.error("No image uploaded. Please upload an image to proceed.")
             return
+        # Imported here, once there is an image to draw on: the canvas component is one of
+        # the slowest imports on the upload page
+        from canvas_component import render_canvas_background, st_canvas_with_background
 
-        # Get dimensions of the current image
-        original_width, original_height = st.session_state.current_image.size
-
-        # Calculate scaling factor if the width exceeds 1000px
-        if original_width > 1000:
-            scaling_factor = 1000 / original_width
-            canvas_width = 1000
-            canvas_height = int(original_height * scaling_factor)
-        else:
-            canvas_width = original_width
-            canvas_height = original_height
-
-        # Resize the image to fit within 1000px width if needed
-        resized_image = st.session_state.current_image.resize((canvas_width, canvas_height))
+        # The preview only changes with the image, so it is rendered and encoded once
+        # per image version rather than on every rerun
+        version = f"{st.session_state.image_update_counter}-{st.session_state.current_snapshot.digest[:16]}"
+        background = st.session_state.canvas_background
+        if background is None or background["version"] != version:
+            with metrics.stage("canvas_preview"):
+                canvas_width, canvas_height, background_png = render_canvas_background(
+                    self.current_image, max_width=1000)
+            background = {
+                "version": version,
+                "width": canvas_width,
+                "height": canvas_height,
+                "png": background_png,
+            }
+            st.session_state.canvas_background = background
 
         # Add canvas with the resized image dimensions
         try:
-            self.canvas_result = st_canvas(
+            self.canvas_result = st_canvas_with_background(
+                background["png"],
+                background["version"],
                 fill_color="rgba(255, 255, 255, 0.3)",  # Transparent fill color
                 stroke_width=st.session_state.stroke_width,
                 stroke_color="#FFFFFF",
-                background_image=resized_image,  # Use resized image as background
-                height=canvas_height,
-                width=canvas_width,
+                height=background["height"],
+                width=background["width"],
                 drawing_mode="freedraw",
                 key=f"canvas_{st.session_state.image_update_counter}",  # Unique key for refreshing canvas
             )
@@ -222,122 +546,536 @@ class InteractiveImageApp:
             st.session_state.action = "CompleteMakeOverAI"
             st.session_state.selected_item = "CompleteMakeOverAI"
         else:
-            action_options = ["Add Item", "Erase"]
+            action_options = ["Add Item", "Batch Add Items", "Erase"]
             st.session_state.action = st.radio(
                 "Choose an action:", action_options)
 
+            if st.session_state.action in ("Add Item", "Batch Add Items"):
+                item_list = self.search_items()
             if st.session_state.action == "Add Item":
                 st.markdown(
                     "<h1 style='color: var(--highlight-text-color);'>Select Item to Add:</h1>", unsafe_allow_html=True)
 
-                item_list = [item for item in item_prompts.keys()
-                             if item != "CompleteMakeOverAI"]
                 st.session_state.selected_item = st.selectbox(
                     "Choose an item to add:", item_list)
+                st.session_state.prefetch_enabled = st.checkbox(
+                    "Prefetch the most popular items while I draw", value=st.session_state.prefetch_enabled,
+                    help="Starts generating the most selected items in the background once the mask is "
+                         "drawn, so choosing one of them returns right away.")
+            elif st.session_state.action == "Batch Add Items":
+                st.markdown(
+                    "<h1 style='color: var(--highlight-text-color);'>Select Items to Add:</h1>", unsafe_allow_html=True)
+
+                st.session_state.selected_item = None
+                vary_by = st.radio("Generate variants by:", ["Items", "Seeds"], horizontal=True)
+                if vary_by == "Items":
+                    # One variant per selected item
+                    st.session_state.batch_items = st.multiselect(
+                        "Choose items to add:", item_list)
+                    st.session_state.batch_seed_count = 1
+                else:
+                    # Several seeds for the same item
+                    item = st.selectbox("Choose an item to add:", item_list)
+                    st.session_state.batch_items = [item] if item else []
+                    st.session_state.batch_seed_count = st.number_input(
+                        "Number of variants:", min_value=2, max_value=8, value=4)
+                st.session_state.batch_parallelism = st.slider(
+                    "Parallel requests:", min_value=1, max_value=8, value=4)
             else:
                 st.session_state.selected_item = None
 
+    def search_items(self):
+        # Search box plus style/category/room filters over the catalogue index, so the
+        # pickers list at most MAX_ITEM_OPTIONS matches however large the catalogue is
+        catalogue = self.item_prompts
+        query = st.text_input("Search items:", key="item_query", placeholder="e.g. sofa, wood, lamp")
+        filters = [(facet, label) for facet, label in [("style", "Style"), ("category", "Category"), ("room", "Room")]
+                   if len(catalogue.facet_values(facet)) > 1]
+        facets = {}
+        if filters:
+            for (facet, label), column in zip(filters, st.columns(len(filters))):
+                with column:
+                    value = st.selectbox(label, ["Any"] + catalogue.facet_values(facet), key=f"item_{facet}")
+                    facets[facet] = None if value == "Any" else value
+        item_list = catalogue.search(query, limit=MAX_ITEM_OPTIONS,
+                                     exclude=("CompleteMakeOverAI",), **facets)
+        if not item_list:
+            st.info("No items match the search.")
+        return item_list
+
+    def select_mask_options(self):
+        with st.expander("Mask options"):
+            st.session_state.mask_dilation = st.slider(
+                "Grow mask (px):", min_value=0, max_value=30, value=st.session_state.mask_dilation)
+            st.session_state.mask_feather = st.slider(
+                "Feather edges (px):", min_value=0, max_value=30, value=st.session_state.mask_feather)
+
+    def select_preview_mode(self):
+        if st.session_state.action == "Batch Add Items":
+            return
+        st.session_state.preview_mode = st.radio(
+            "Generation mode:", PREVIEW_MODES, index=PREVIEW_MODES.index(st.session_state.preview_mode))
+
+    def uses_preview(self):
+        return st.session_state.preview_mode != PREVIEW_OFF and st.session_state.action != "Batch Add Items"
+
+    def mask_signature(self):
+        # The image and the strokes and options the mask is built from
+        canvas_data = self.canvas_result.json_data if self.canvas_result is not None else None
+        state = [
+            st.session_state.current_snapshot.digest,
+            canvas_data,
+            st.session_state.mask_dilation,
+            st.session_state.mask_feather,
+        ]
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+    def generation_signature(self):
+        # Everything a preview depends on; if any of it changes the preview is stale
+        state = [self.mask_signature(), st.session_state.action, st.session_state.selected_item]
+        return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
     def handle_image_generation(self):
+        # A generation is in flight: poll it instead of offering a new one
+        if st.session_state.generation_job is not None:
+            self.poll_generation_job()
+            return
+        if st.session_state.batch_jobs:
+            self.poll_batch_jobs()
+            return
+        if st.session_state.preview is not None:
+            if self.generation_signature() == st.session_state.preview["signature"]:
+                self.poll_preview()
+                return
+            # The mask, item or image changed since the preview was requested
+            self.discard_preview("invalidated")
+        self.update_prefetch()
+
         generate = st.button("Generate Image", key="generate_image")
         if generate:
             if self.canvas_result.image_data is not None:
-                # Store the canvas drawing data
-                st.session_state.canvas_data = self.canvas_result.json_data
-
-                with st.spinner("Processing the image..."):
-                    # Create the mask from the canvas
-                    mask_image = create_mask_from_canvas(self.canvas_result)
-
-                    # Resize the mask to the original image size
-                    width, height = st.session_state.current_image.size
-                    mask_image = mask_image.resize(
-                        (width, height), resample=Image.NEAREST)
-                    # Save the mask locally with a timestamp
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    mask_dir = os.path.join("saved_masks")
-                    os.makedirs(mask_dir, exist_ok=True)
-                    mask_path = os.path.join(mask_dir, f"mask_{timestamp}.png")
-                    mask_image.save(mask_path)
-
-                    # Save the current image to temporary files
-                    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as image_file:
-                        st.session_state.current_image.save(image_file.name)
-                        image_path = image_file.name
-
-                    # Handle actions
-                    if st.session_state.action == "Add Item" and st.session_state.has_generated_image:
-                        selected_item = st.session_state.selected_item
-                        if selected_item and selected_item in item_prompts:
-                            prompt = item_prompts[selected_item]["prompt"]
-                            negative_prompt = item_prompts[selected_item]["negative_prompt"]
-                        else:
-                            st.error("Please select an item to add.")
-                            return
-
-                        # Call the in-painting API
-                        response = self.api_client.inpaint_image(
-                            prompt=prompt,
-                            negative_prompt=negative_prompt,
-                            image_path=image_path,
-                            mask_path=mask_path,
-                            output_format="png"
-                        )
-                    elif st.session_state.action == "Erase" and st.session_state.has_generated_image:
-                        # Set prompt for erasing
-                        prompt = "Erase the selected area and fill it naturally."
-                        negative_prompt = (
-                            "Do not leave any traces of the erased object. Ensure seamless blending with the surrounding environment."
-                        )
-
-                        # Call the erase API
-                        response = self.api_client.erase_image(
-                            prompt=prompt,
-                            negative_prompt=negative_prompt,
-                            image_path=image_path,
-                            mask_path=mask_path,
-                            output_format="png"
-                        )
-                    else:  # Default action (CompleteMakeOverAI)
-                        prompt = item_prompts["CompleteMakeOverAI"]["prompt"]
-                        negative_prompt = item_prompts["CompleteMakeOverAI"]["negative_prompt"]
-
-                        # Call the in-painting API
-                        response = self.api_client.inpaint_image(
-                            prompt=prompt,
-                            negative_prompt=negative_prompt,
-                            image_path=image_path,
-                            mask_path=mask_path,
-                            output_format="png"
-                        )
-
-                    if response.status_code == 200:
-                        try:
-                            # Open and store the generated image
-                            output_image = Image.open(
-                                BytesIO(response.content))
-                            st.success("Image processed successfully!")
-                            # Save the current image to history
-                            st.session_state.image_history.append(
-                                st.session_state.current_image.copy())
-                            # Update the current image with the generated image
-                            st.session_state.current_image = output_image.copy()
-                            # Update state to enable additional actions
-                            st.session_state.has_generated_image = True
-                            st.session_state.image_update_counter += 1
-                            st.rerun()                       
-                        except Exception as e:
-                            st.error(
-                                f"Failed to process the generated image: {e}")
+                image = self.current_image
+                mask_image, crop_image, crop_mask, box, crop_mask_bytes = self.mask_region(image)
+
+                # Handle actions
+                if st.session_state.action == "Batch Add Items" and st.session_state.has_generated_image:
+                    if not st.session_state.batch_items:
+                        st.error("Please select at least one item to add.")
+                        return
+                    for item in st.session_state.batch_items:
+                        get_selection_counts().record(item)
+                    self.submit_batch(image, mask_image, crop_image, crop_mask_bytes, box)
+                    st.experimental_rerun()
+                elif st.session_state.action == "Add Item" and st.session_state.has_generated_image:
+                    selected_item = st.session_state.selected_item
+                    if selected_item and selected_item in self.item_prompts:
+                        prompt = self.item_prompts[selected_item]["prompt"]
+                        negative_prompt = self.item_prompts[selected_item]["negative_prompt"]
                     else:
-                        st.error(
-                            f"Error: {response.status_code} - {response.text}")
+                        st.error("Please select an item to add.")
+                        return
+                    get_selection_counts().record(selected_item)
+
+                    # A finished prefetch for this item and mask is used as is
+                    job_id = self.take_prefetched(selected_item)
+                    if job_id is not None:
+                        st.session_state.generation_job = {"id": job_id, "status": DONE, "prefetched": True}
+                        st.experimental_rerun()
+
+                    # Call the in-painting API
+                    generate_fn = self.api_client.inpaint_image
+                    grow_mask = self.inpaint_grow_mask()
+                elif st.session_state.action == "Erase" and st.session_state.has_generated_image:
+                    # Set prompt for erasing
+                    prompt = "Erase the selected area and fill it naturally."
+                    negative_prompt = (
+                        "Do not leave any traces of the erased object. Ensure seamless blending with the surrounding environment."
+                    )
 
-                    # Clean up temporary files
-                    os.remove(image_path)
+                    # Call the erase API
+                    generate_fn = self.api_client.erase_image
+                    grow_mask = 0 if self.uses_local_mask_options() else None
+                else:  # Default action (CompleteMakeOverAI)
+                    prompt = self.item_prompts["CompleteMakeOverAI"]["prompt"]
+                    negative_prompt = self.item_prompts["CompleteMakeOverAI"]["negative_prompt"]
+
+                    # Call the in-painting API
+                    generate_fn = self.api_client.inpaint_image
+                    grow_mask = self.inpaint_grow_mask()
+
+                kwargs = {
+                    "prompt": prompt,
+                    "negative_prompt": negative_prompt,
+                    "image": crop_image,
+                    "mask": crop_mask_bytes,
+                    "output_format": "png",
+                    "grow_mask": grow_mask,
+                }
+                if self.uses_preview():
+                    self.submit_preview(generate_fn, image, mask_image, box, crop_mask, kwargs)
+                    st.experimental_rerun()
+
+                # Hand the upstream call to the shared executor; this rerun returns immediately
+                job_id = self.executor.submit(
+                    generate_region, generate_fn, image, mask_image, box,
+                    rate_key=self.api_client.api_key, **kwargs)
+                st.session_state.generation_job = {"id": job_id, "status": QUEUED}
+                st.experimental_rerun()
             else:
                 st.warning("Please draw on the canvas to create a mask.")
 
+    def mask_region(self, image):
+        mask = self.current_mask(image.size)
+        # Only the masked region plus some context is uploaded; the result is
+        # composited back into the full-resolution image by the job
+        with metrics.stage("crop"):
+            crop_image, crop_mask, box = crop_to_mask(image, mask["image"], max_pixels=MAX_UPLOAD_PIXELS)
+            if mask["crop_bytes"] is None:
+                mask["crop_bytes"] = encode_image(crop_mask, "png")
+        return mask["image"], crop_image, crop_mask, box, mask["crop_bytes"]
+
+    def update_prefetch(self):
+        # Keep speculative jobs in step with the mask: a changed mask cancels the old ones
+        # and, once the new strokes have been left alone for PREFETCH_DELAY, starts the most
+        # selected items. Their requests match what "Generate Image" sends, so a choice
+        # still in flight joins it and a finished one is taken from its job.
+        if not (st.session_state.prefetch_enabled and st.session_state.action == "Add Item"
+                and st.session_state.has_generated_image):
+            self.cancel_prefetch()
+            return
+        if self.canvas_result is None or not (self.canvas_result.json_data or {}).get("objects"):
+            self.cancel_prefetch()
+            return
+        signature = self.mask_signature()
+        if st.session_state.prefetch is not None and st.session_state.prefetch["signature"] == signature:
+            return
+        self.cancel_prefetch()
+
+        region = PrefetchRegion(self.canvas_result, self.current_image, dilation=st.session_state.mask_dilation,
+                                feather=st.session_state.mask_feather, max_pixels=MAX_UPLOAD_PIXELS)
+        item_list = [item for item in self.item_prompts.keys() if item != "CompleteMakeOverAI"]
+        cancelled = threading.Event()
+        budgets = [st.session_state.prefetch_budget, get_prefetch_budget()]
+        jobs = {}
+        for item in get_selection_counts().top(PREFETCH_ITEMS, item_list):
+            jobs[item] = get_prefetch_executor().submit(
+                prefetch_region, cancelled, PREFETCH_DELAY, budgets, region,
+                self.api_client.inpaint_image,
+                prompt=self.item_prompts[item]["prompt"],
+                negative_prompt=self.item_prompts[item]["negative_prompt"],
+                output_format="png",
+                grow_mask=self.inpaint_grow_mask(),
+            )
+        st.session_state.prefetch = {"signature": signature, "cancelled": cancelled, "jobs": jobs}
+
+    def take_prefetched(self, item):
+        prefetch = st.session_state.prefetch
+        if prefetch is None or prefetch["signature"] != self.mask_signature():
+            return None
+        job_id = prefetch["jobs"].get(item)
+        job = get_prefetch_executor().get(job_id) if job_id is not None else None
+        # A prefetch whose upstream call failed is a miss too: the user gets a fresh
+        # attempt rather than a stale error
+        if job is None or job.status != DONE or job.result is None or job.result[1] is None:
+            metrics.inc("prefetch_total", result="miss")
+            return None
+        del prefetch["jobs"][item]
+        metrics.inc("prefetch_total", result="hit")
+        return job_id
+
+    def cancel_prefetch(self):
+        prefetch = st.session_state.prefetch
+        if prefetch is None:
+            return
+        prefetch["cancelled"].set()
+        for job_id in prefetch["jobs"].values():
+            get_prefetch_executor().cancel(job_id)
+        st.session_state.prefetch = None
+
+    def current_mask(self, size):
+        # The strokes are compared with the ones behind the last mask: an unchanged mask
+        # (e.g. retrying, or trying another item on the same spot) is not rasterised,
+        # contoured or encoded again
+        options = [size[0], size[1], st.session_state.mask_dilation, st.session_state.mask_feather]
+        mask = st.session_state.current_mask
+        if (mask is not None and mask["options"] == options
+                and st.session_state.canvas_data == self.canvas_result.json_data):
+            metrics.inc("mask_reuse_total", result="hit")
+            return mask
+        metrics.inc("mask_reuse_total", result="miss")
+        st.session_state.canvas_data = self.canvas_result.json_data
+
+        # Create the mask from the canvas at the original image size
+        with metrics.stage("mask_build"):
+            mask_image = build_mask_from_canvas(
+                self.canvas_result,
+                size,
+                dilation=st.session_state.mask_dilation,
+                feather=st.session_state.mask_feather,
+            )
+        with metrics.stage("mask_encode"):
+            mask_bytes = encode_image(mask_image, "png")
+        # Archive the full-size mask under its content hash
+        digest = hashlib.sha256(mask_bytes).hexdigest()
+        mask_store = get_mask_store()
+        if not mask_store.contains(f"{digest}.png"):
+            mask_store.put(f"{digest}.png", mask_bytes)
+
+        # The encoded crop of the mask is filled in by the caller and reused with the mask
+        mask = {"options": options, "image": mask_image, "digest": digest, "crop_bytes": None}
+        st.session_state.current_mask = mask
+        return mask
+
+    def submit_preview(self, generate_fn, image, mask_image, box, crop_mask, kwargs):
+        # Same seed for both passes so the full-resolution result resembles the preview
+        kwargs["seed"] = random.randint(0, 4294967294)
+        with metrics.stage("preview_downscale"):
+            preview_image, preview_mask = downscale_for_preview(kwargs["image"], crop_mask)
+        # composite_region scales the small result back up to the box
+        preview_job = self.executor.submit(
+            generate_region, generate_fn, image, mask_image, box, rate_key=self.api_client.api_key,
+            **dict(kwargs, image=preview_image, mask=encode_image(preview_mask, "png"), output_format="jpeg"))
+        full_call = (generate_fn, image, mask_image, box, kwargs)
+        full_job = None
+        if st.session_state.preview_mode == PREVIEW_SPECULATIVE:
+            full_job = self.executor.submit(
+                generate_region, generate_fn, image, mask_image, box, rate_key=self.api_client.api_key, **kwargs)
+        st.session_state.preview = {
+            "job": preview_job,
+            "full_call": full_call,
+            "full_job": full_job,
+            "image": None,
+            "error": None,
+            "signature": self.generation_signature(),
+        }
+
+    def poll_preview(self):
+        preview = st.session_state.preview
+        if preview["image"] is None and preview["error"] is None:
+            job = self.executor.get(preview["job"])
+            if job is None:
+                preview["error"] = "The preview job was lost."
+            elif job.finished:
+                self.executor.pop(job.id)
+                if job.status == FAILED:
+                    preview["error"] = str(job.error)
+                else:
+                    response, output_image = job.result
+                    if output_image is None:
+                        preview["error"] = f"{response.status_code} - {response.text}"
+                    else:
+                        preview["image"] = output_image
+
+        st.markdown(
+            "<h1 style='color: var(--highlight-text-color);'>Preview:</h1>", unsafe_allow_html=True)
+        pending = preview["image"] is None and preview["error"] is None
+        if preview["image"] is not None:
+            st.image(preview["image"], caption="Low-resolution preview", use_column_width=True)
+        elif preview["error"] is not None:
+            st.error(f"Preview failed: {preview['error']}")
+        else:
+            st.info("Generating a quick preview...")
+
+        if not pending and st.button("Accept and generate full resolution"):
+            self.accept_preview()
+        if st.button("Discard Preview"):
+            self.discard_preview("discarded")
+            st.experimental_rerun()
+        if pending:
+            self.poll_again()
+
+    def accept_preview(self):
+        # Hand over to the regular generation poll; a speculative call may already be done
+        preview = st.session_state.preview
+        job_id = preview["full_job"]
+        if job_id is None:
+            generate_fn, image, mask_image, box, kwargs = preview["full_call"]
+            job_id = self.executor.submit(
+                generate_region, generate_fn, image, mask_image, box, rate_key=self.api_client.api_key, **kwargs)
+        st.session_state.preview = None
+        st.session_state.generation_job = {"id": job_id, "status": QUEUED}
+        metrics.inc("previews_total", outcome="accepted")
+        st.experimental_rerun()
+
+    def discard_preview(self, outcome):
+        # Cancel the preview and any speculative full-resolution call; queued ones never
+        # reach the API
+        preview = st.session_state.preview
+        self.executor.cancel(preview["job"])
+        if preview["full_job"] is not None:
+            self.executor.cancel(preview["full_job"])
+        st.session_state.preview = None
+        metrics.inc("previews_total", outcome=outcome)
+
+    def uses_local_mask_options(self):
+        return st.session_state.mask_dilation > 0 or st.session_state.mask_feather > 0
+
+    def inpaint_grow_mask(self):
+        # Local dilation/feathering replaces the API's own mask growth
+        return 0 if self.uses_local_mask_options() else 1
+
+    def submit_batch(self, image, mask_image, crop_image, crop_mask_bytes, box):
+        # Encode the cropped region once; every call in the fan-out uploads the same bytes
+        image_bytes = self.api_client.encode(crop_image)
+        base_seed = random.randint(0, 4294967294 - MAX_BATCH_SEEDS)
+        calls = []
+        batch_jobs = []
+        for item in st.session_state.batch_items:
+            for offset in range(st.session_state.batch_seed_count):
+                seed = base_seed + offset
+                calls.append((generate_region, (self.api_client.inpaint_image, image, mask_image, box), {
+                    "prompt": self.item_prompts[item]["prompt"],
+                    "negative_prompt": self.item_prompts[item]["negative_prompt"],
+                    "image": image_bytes,
+                    "mask": crop_mask_bytes,
+                    "output_format": "png",
+                    "seed": seed,
+                    "grow_mask": self.inpaint_grow_mask(),
+                }))
+                label = item if st.session_state.batch_seed_count == 1 else f"{item} (seed {seed})"
+                batch_jobs.append({"label": label, "status": QUEUED, "image": None, "error": None})
+
+        job_ids = self.executor.submit_many(
+            calls, max_parallel=st.session_state.batch_parallelism, rate_key=self.api_client.api_key)
+        for batch_job, job_id in zip(batch_jobs, job_ids):
+            batch_job["id"] = job_id
+        st.session_state.batch_jobs = batch_jobs
+
+    def poll_batch_jobs(self):
+        batch_jobs = st.session_state.batch_jobs
+        # Collect every job that finished since the last rerun
+        for batch_job in batch_jobs:
+            if batch_job["status"] in (DONE, FAILED):
+                continue
+            job = self.executor.get(batch_job["id"])
+            if job is None:
+                batch_job["status"] = FAILED
+                batch_job["error"] = "The generation job was lost."
+                continue
+            batch_job["status"] = job.status
+            if not job.finished:
+                continue
+            self.executor.pop(job.id)
+            if job.status == FAILED:
+                batch_job["error"] = str(job.error)
+            else:
+                response, output_image = job.result
+                if output_image is None:
+                    batch_job["status"] = FAILED
+                    batch_job["error"] = f"{response.status_code} - {response.text}"
+                else:
+                    batch_job["image"] = output_image
+
+        all_finished = all(batch_job["status"] in (DONE, FAILED) for batch_job in batch_jobs)
+        st.markdown(
+            "<h1 style='color: var(--highlight-text-color);'>Variants:</h1>", unsafe_allow_html=True)
+        columns = st.columns(BATCH_GRID_COLUMNS)
+        for index, batch_job in enumerate(batch_jobs):
+            with columns[index % BATCH_GRID_COLUMNS]:
+                if batch_job["image"] is not None:
+                    st.image(batch_job["image"], caption=batch_job["label"], use_column_width=True)
+                    if all_finished and st.button("Use this variant", key=f"use_variant_{index}"):
+                        # Save the current image to history and adopt the chosen variant
+                        st.session_state.image_history.push(
+                            st.session_state.current_snapshot)
+                        self.set_current_image(batch_job["image"])
+                        self.save_result()
+                        st.session_state.batch_jobs = []
+                        st.session_state.image_update_counter += 1
+                        st.experimental_rerun()
+                elif batch_job["status"] == FAILED:
+                    st.error(f"{batch_job['label']}: {batch_job['error']}")
+                else:
+                    st.info(f"{batch_job['label']}: {batch_job['status']}...")
+
+        # Offered while variants are still running too, so a batch can be dropped before
+        # its queued calls are paid for
+        if st.button("Discard Variants"):
+            self.cancel_batch_jobs()
+            st.experimental_rerun()
+        if not all_finished:
+            self.poll_again()
+
+    def poll_again(self):
+        # Rerun after JOB_POLL_INTERVAL. The wait happens in __main__ once the run has been
+        # timed, so script_run measures the rerun itself rather than the poll interval.
+        self.poll_pending = True
+        st.experimental_rerun()
+
+    def cancel_batch_jobs(self):
+        # Queued variants never reach the API; finished ones are already popped
+        for batch_job in st.session_state.batch_jobs:
+            if batch_job["status"] not in (DONE, FAILED):
+                self.executor.cancel(batch_job["id"])
+        st.session_state.batch_jobs = []
+
+    def generation_executor(self, job_state):
+        return get_prefetch_executor() if job_state.get("prefetched") else self.executor
+
+    def cancel_generation_job(self):
+        # A queued call never reaches the API, and a finished result is dropped right away
+        # instead of waiting out finished_ttl
+        job_state = st.session_state.generation_job
+        if job_state is not None:
+            self.generation_executor(job_state).cancel(job_state["id"])
+        st.session_state.generation_job = None
+
+    def poll_generation_job(self):
+        job_state = st.session_state.generation_job
+        executor = self.generation_executor(job_state)
+        job = executor.get(job_state["id"])
+        if job is None:
+            # The executor no longer knows the job, e.g. after a server restart
+            st.session_state.generation_job = None
+            st.error("The generation job was lost. Please try again.")
+            return
+
+        job_state["status"] = job.status
+        if not job.finished:
+            st.info("Processing the image...")
+            # Only the short poll interval is spent on this thread, not the upstream call
+            self.poll_again()
+
+        executor.pop(job.id)
+        st.session_state.generation_job = None
+        if job.status == FAILED:
+            st.error(f"Failed to generate the image: {job.error}")
+            return
+
+        response, output_image = job.result
+        if output_image is not None:
+            try:
+                st.success("Image processed successfully!")
+                # Save the current image to history
+                st.session_state.image_history.push(
+                    st.session_state.current_snapshot)
+                # Update the current image with the generated image; it is already a
+                # fresh composite, so no extra copy is needed
+                self.set_current_image(output_image)
+                self.save_result()
+                # Update state to enable additional actions
+                st.session_state.has_generated_image = True
+                st.session_state.image_update_counter += 1
+                st.experimental_rerun()
+            except Exception as e:
+                st.error(
+                    f"Failed to process the generated image: {e}")
+        else:
+            st.error(
+                f"Error: {response.status_code} - {response.text}")
+
 
 if __name__ == "__main__":
-    app = InteractiveImageApp(API_KEY)
-    app.run()
+    # st.experimental_rerun() ends the script with an exception, which still counts as a finished run
+    app = None
+    try:
+        with metrics.stage("script_run"):
+            app = InteractiveImageApp(API_KEY)
+            try:
+                app.run()
+            finally:
+                # Also runs when st.experimental_rerun() ends the script early
+                app.persist_session()
+    finally:
+        if app is not None and app.poll_pending:
+            time.sleep(JOB_POLL_INTERVAL)
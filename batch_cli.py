@@ -0,0 +1,240 @@
+# Headless batch runner for offline room makeovers, e.g. staging listing photos overnight.
+#
+#   python batch_cli.py photos/ out/ --workers 8
+#   python batch_cli.py manifest.jsonl out/ --operation search-and-replace
+#   python batch_cli.py manifest.jsonl out/ --operation makeover
+#
+# A manifest has one JSON object per line: {"image": "...", "mask": "...", "item": "Sofa"}.
+# "mask" and "item" are optional; without a mask the whole frame is regenerated and the
+# item defaults to --item. Completed jobs are appended to <output>/progress.jsonl, and a
+# rerun after a crash skips everything already recorded there.
+#
+# "makeover" refreshes the floor and walls (search-and-replace) and inpaints the item on
+# the result in one pipeline. Its "item" may be a list: the refresh runs once and each
+# item is added to it concurrently. Step outputs are cached in <output>/.pipeline_cache,
+# so rerunning with other items reuses the refreshed room.
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+from PIL import Image
+
+from api_client import StabilityAIClient, DEFAULT_BASE_URL
+from image_processing import (
+    PREPROCESS_PROMPT, PREPROCESS_NEGATIVE_PROMPT, load_image, crop_to_mask, generate_region,
+)
+from job_queue import RateLimiter
+from pipeline import Pipeline, SearchAndReplace, Inpaint
+from prompt_catalogue import PromptCatalogue
+from result_cache import ResultCache
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+OPERATIONS = ("inpaint", "search-and-replace", "makeover")
+PROGRESS_LOG = "progress.jsonl"
+PIPELINE_CACHE = ".pipeline_cache"
+CREDIT_REFRESH_INTERVAL = 300
+# Same catalogue as the app; the built-in prompts are used if the file is missing
+item_prompts = PromptCatalogue(os.environ.get("PROMPT_CATALOGUE", "catalogue/prompts.json"))
+
+
+def read_jobs(source, default_item, default_operation):
+    if os.path.isdir(source):
+        entries = [
+            {"image": os.path.join(source, name)}
+            for name in sorted(os.listdir(source))
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+    else:
+        with open(source) as manifest:
+            entries = [json.loads(line) for line in manifest if line.strip()]
+
+    jobs = []
+    for entry in entries:
+        job = {
+            "image": entry["image"],
+            "mask": entry.get("mask"),
+            "item": entry.get("item", default_item),
+            "operation": entry.get("operation", default_operation),
+        }
+        if job["operation"] not in OPERATIONS:
+            raise ValueError(f"Unknown operation {job['operation']!r} for {job['image']}")
+        if isinstance(job["item"], list) and job["operation"] != "makeover":
+            raise ValueError(f"Only makeover jobs take a list of items: {job['image']}")
+        items = job["item"] if isinstance(job["item"], list) else [job["item"]]
+        for item in items:
+            if job["operation"] != "search-and-replace" and item not in item_prompts:
+                raise ValueError(f"Unknown item {item!r} for {job['image']}")
+        identity = json.dumps([job["image"], job["mask"], job["item"], job["operation"]])
+        job["key"] = hashlib.sha256(identity.encode()).hexdigest()[:16]
+        jobs.append(job)
+    return jobs
+
+
+def read_completed(progress_path):
+    completed = set()
+    if not os.path.exists(progress_path):
+        return completed
+    with open(progress_path) as progress:
+        for line in progress:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash; that job simply runs again
+                continue
+            if record.get("status") == "ok":
+                completed.add(record["key"])
+    return completed
+
+
+def run_makeover(job, client, limiter, output_dir, image, stem, pipeline_cache):
+    items = job["item"] if isinstance(job["item"], list) else [job["item"]]
+    if job["mask"]:
+        mask_image = Image.open(job["mask"]).convert("L").resize(image.size, Image.NEAREST)
+    else:
+        mask_image = Image.new("L", image.size, 255)
+    pipeline = Pipeline(client, [SearchAndReplace(PREPROCESS_PROMPT, PREPROCESS_NEGATIVE_PROMPT)],
+                        cache=pipeline_cache, max_workers=len(items))
+    branches = {
+        item: [Inpaint(item_prompts[item]["prompt"], item_prompts[item]["negative_prompt"], mask_image)]
+        for item in items
+    }
+
+    # One upstream call for the refresh plus one per item
+    for _ in range(1 + len(items)):
+        limiter.acquire()
+    started = time.perf_counter()
+    results = pipeline.run_branches(image, branches)
+    latency = time.perf_counter() - started
+    output_paths = []
+    for item, result in results.items():
+        if result.status_code != 200:
+            raise RuntimeError(f"{item}: {result.status_code} - {result.text}")
+        output_path = os.path.join(output_dir, f"{stem}_{job['key']}_{item.replace(' ', '_')}.png")
+        with open(output_path, "wb") as output_file:
+            result.write_to(output_file)
+        output_paths.append(output_path)
+    return output_paths if len(output_paths) > 1 else output_paths[0], latency
+
+
+def run_job(job, client, limiter, output_dir, max_pixels, pipeline_cache=None):
+    image = load_image(job["image"], max_pixels=max_pixels)
+    stem = os.path.splitext(os.path.basename(job["image"]))[0]
+
+    if job["operation"] == "makeover":
+        return run_makeover(job, client, limiter, output_dir, image, stem, pipeline_cache)
+
+    limiter.acquire()
+    started = time.perf_counter()
+    if job["operation"] == "search-and-replace":
+        response = client.search_and_replace_image(PREPROCESS_PROMPT, PREPROCESS_NEGATIVE_PROMPT, image)
+        latency = time.perf_counter() - started
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code} - {response.text}")
+        output_path = os.path.join(output_dir, f"{stem}_{job['key']}.jpeg")
+        with open(output_path, "wb") as output_file:
+            response.write_to(output_file)
+        return output_path, latency
+
+    if job["mask"]:
+        mask_image = Image.open(job["mask"]).convert("L").resize(image.size, Image.NEAREST)
+    else:
+        mask_image = Image.new("L", image.size, 255)
+    crop_image, crop_mask, box = crop_to_mask(image, mask_image)
+    response, output_image = generate_region(
+        client.inpaint_image,
+        image,
+        mask_image,
+        box,
+        prompt=item_prompts[job["item"]]["prompt"],
+        negative_prompt=item_prompts[job["item"]]["negative_prompt"],
+        image=crop_image,
+        mask=crop_mask,
+        output_format="png",
+    )
+    latency = time.perf_counter() - started
+    if output_image is None:
+        raise RuntimeError(f"{response.status_code} - {response.text}")
+    output_path = os.path.join(output_dir, f"{stem}_{job['key']}.png")
+    output_image.save(output_path, compress_level=1)
+    return output_path, latency
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run room makeovers headlessly over a directory or manifest.")
+    parser.add_argument("source", help="directory of images or JSONL manifest")
+    parser.add_argument("output_dir")
+    parser.add_argument("--operation", choices=OPERATIONS, default="inpaint")
+    parser.add_argument("--item", default="CompleteMakeOverAI", help="catalogue item for inpaint jobs")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests-per-second", type=float, default=10)
+    parser.add_argument("--max-pixels", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--api-key", default=None,
+                        help="defaults to the STABILITY_AI environment variable; separate several keys with commas")
+    parser.add_argument("--base-url", default=DEFAULT_BASE_URL)
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    api_key = args.api_key or os.environ.get("STABILITY_AI")
+    if not api_key:
+        parser.error("no API key: pass --api-key or set STABILITY_AI")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress_path = os.path.join(args.output_dir, PROGRESS_LOG)
+    jobs = read_jobs(args.source, args.item, args.operation)
+    completed = read_completed(progress_path)
+    pending = [job for job in jobs if job["key"] not in completed]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(pending)} already done, {len(pending)} to run")
+
+    client = StabilityAIClient(api_key, base_url=args.base_url, pool_size=args.workers)
+    # Long runs can exhaust an account; keys out of credits are skipped until topped up
+    client.start_credit_refresh(CREDIT_REFRESH_INTERVAL)
+    limiter = RateLimiter(args.requests_per_second)
+    pipeline_cache = ResultCache(os.path.join(args.output_dir, PIPELINE_CACHE))
+    progress_lock = threading.Lock()
+    latencies = []
+    failures = 0
+    started = time.perf_counter()
+
+    with open(progress_path, "a") as progress, ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(run_job, job, client, limiter, args.output_dir, args.max_pixels, pipeline_cache): job
+            for job in pending
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            record = {"key": job["key"], "image": job["image"], "item": job["item"], "operation": job["operation"]}
+            try:
+                output_path, latency = future.result()
+                record.update(status="ok", output=output_path, latency=round(latency, 3))
+                latencies.append(latency)
+            except Exception as e:
+                record.update(status="failed", error=str(e))
+                failures += 1
+                print(f"failed: {job['image']}: {e}", file=sys.stderr)
+            with progress_lock:
+                progress.write(json.dumps(record) + "\n")
+                progress.flush()
+    client.close()
+
+    wall_time = time.perf_counter() - started
+    print(f"completed: {len(latencies)}, failed: {failures}, wall time: {wall_time:.1f}s")
+    if latencies:
+        print(f"throughput: {len(latencies) / wall_time * 60:.1f} images/min")
+        print(f"latency p50: {percentile(latencies, 0.5):.2f}s  p95: {percentile(latencies, 0.95):.2f}s  "
+              f"max: {max(latencies):.2f}s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+# Prompt catalogue at SKU scale: writes a synthetic catalogue of --items entries as JSON
+# and SQLite, then times the first load (read + index), the searches the item picker
+# runs on every rerun, and a hot reload after the file is edited. Search times should
+# stay in the tens of microseconds to low milliseconds however large the catalogue is.
+#
+#   python -m benchmarks.bench_catalogue --items 50000
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from prompt_catalogue import PromptCatalogue
+
+CATEGORIES = ["Seating", "Tables", "Lighting", "Storage", "Textiles", "Decor", "Electronics"]
+STYLES = ["Scandinavian", "Modern", "Classic", "Industrial", "Boho", "Minimalist", "Rustic"]
+ROOMS = ["Living Room", "Bedroom", "Kitchen", "Dining Room", "Office", "Bathroom"]
+NOUNS = ["sofa", "armchair", "table", "lamp", "shelf", "rug", "curtain", "mirror", "vase", "bench",
+         "stool", "cabinet", "dresser", "clock", "plant", "painting", "cushion", "bed", "desk", "chair"]
+MATERIALS = ["oak", "walnut", "pine", "glass", "marble", "linen", "velvet", "leather", "brass", "steel"]
+QUERIES = ["", "so", "sofa", "oak sofa", "velvet arm", "lamp brass", "zzz"]
+
+
+def synthetic_entries(count, seed=0):
+    rng = random.Random(seed)
+    entries = []
+    for number in range(count):
+        noun, material = rng.choice(NOUNS), rng.choice(MATERIALS)
+        style = rng.choice(STYLES)
+        entries.append({
+            "name": f"{material.title()} {noun.title()} {number:06d}",
+            "prompt": f"A {style.lower()} {material} {noun} that fits the room's decor.",
+            "negative_prompt": "Avoid deformed structures or mismatched styles.",
+            "category": rng.choice(CATEGORIES),
+            "style": style,
+            "room": rng.choice(ROOMS),
+            "keywords": [noun, material],
+        })
+    return entries
+
+
+def write_json(path, entries):
+    with open(path, "w") as file:
+        json.dump({"items": entries}, file)
+
+
+def write_sqlite(path, entries):
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE prompts (name TEXT PRIMARY KEY, prompt TEXT NOT NULL, negative_prompt TEXT, "
+        "category TEXT, style TEXT, room TEXT, keywords TEXT)")
+    connection.executemany(
+        "INSERT INTO prompts VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(entry["name"], entry["prompt"], entry["negative_prompt"], entry["category"], entry["style"],
+          entry["room"], ",".join(entry["keywords"])) for entry in entries])
+    connection.commit()
+    connection.close()
+
+
+def time_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def bench(label, path, rewrite, repeat):
+    catalogue = PromptCatalogue(path, reload_interval=0)
+    started = time.perf_counter()
+    count = len(catalogue)
+    print(f"{label}: {count} items, first load {(time.perf_counter() - started) * 1000:.0f} ms")
+    for query in QUERIES:
+        matches = len(catalogue.search(query, limit=10 ** 9))
+        median = time_ms(lambda: catalogue.search(query, limit=200), repeat)
+        print(f"  search {query!r:14} {matches:>7} matches  {median:.3f} ms")
+    median = time_ms(lambda: catalogue.search("sofa", limit=200, style="Scandinavian", room="Bedroom"), repeat)
+    print(f"  search 'sofa' + style + room      {median:.3f} ms")
+
+    rewrite()
+    os.utime(path, (time.time() + 1, time.time() + 1))
+    # The read that notices the change returns the old version straight away
+    started = time.perf_counter()
+    catalogue.search("sofa", limit=200)
+    noticed = (time.perf_counter() - started) * 1000
+    while len(catalogue) == count:
+        time.sleep(0.01)
+    print(f"  hot reload: search during reload {noticed:.3f} ms, "
+          f"new version after {(time.perf_counter() - started) * 1000:.0f} ms with {len(catalogue)} items")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    entries = synthetic_entries(args.items)
+    extra = synthetic_entries(args.items + 100)[args.items:]
+    with tempfile.TemporaryDirectory() as workdir:
+        json_path = os.path.join(workdir, "prompts.json")
+        write_json(json_path, entries)
+        bench("json", json_path, lambda: write_json(json_path, entries + extra), args.repeat)
+
+        sqlite_path = os.path.join(workdir, "prompts.sqlite")
+        write_sqlite(sqlite_path, entries)
+        bench("sqlite", sqlite_path, lambda: write_sqlite(sqlite_path + ".new", entries + extra)
+              or os.replace(sqlite_path + ".new", sqlite_path), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
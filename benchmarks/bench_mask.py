@@ -0,0 +1,95 @@
+# Micro-benchmark: create_mask_from_canvas + PIL NEAREST upscale (the original path)
+# versus build_mask_from_canvas, for 1K/4K/8K target images. Each case runs in a fresh
+# process so the peak RSS growth it reports belongs to that case alone.
+#
+#   python -m benchmarks.bench_mask --repeat 5
+import argparse
+import multiprocessing
+import resource
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from image_processing import build_mask_from_canvas, create_mask_from_canvas
+
+# Target image sizes (width, height); the canvas is scaled to 1000 px wide like the app does
+SIZES = {
+    "1K": (1024, 768),
+    "4K": (3840, 2160),
+    "8K": (7680, 4320),
+}
+CANVAS_WIDTH = 1000
+
+
+class FakeCanvasResult:
+    def __init__(self, image_data):
+        self.image_data = image_data
+
+
+def make_canvas(output_size):
+    width = CANVAS_WIDTH
+    height = int(output_size[1] * CANVAS_WIDTH / output_size[0])
+    rng = np.random.default_rng(0)
+    image_data = np.zeros((height, width, 4), dtype=np.uint8)
+    # A closed loop (exercises hole filling) and a few free strokes
+    cv2.ellipse(image_data, (width // 2, height // 2), (width // 5, height // 5), 0, 0, 360,
+                (255, 255, 255, 77), 25)
+    for _ in range(8):
+        start = tuple(int(v) for v in rng.integers(0, (width, height)))
+        end = tuple(int(v) for v in rng.integers(0, (width, height)))
+        cv2.line(image_data, start, end, (255, 255, 255, 77), 25)
+    return FakeCanvasResult(image_data)
+
+
+def original_pipeline(canvas_result, output_size):
+    mask_image = create_mask_from_canvas(canvas_result)
+    return mask_image.resize(output_size, resample=Image.NEAREST)
+
+
+def new_pipeline(canvas_result, output_size):
+    return build_mask_from_canvas(canvas_result, output_size)
+
+
+PIPELINES = {"original": original_pipeline, "build_mask": new_pipeline}
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_case(pipeline_name, size_name, repeat, queue):
+    output_size = SIZES[size_name]
+    canvas_result = make_canvas(output_size)
+    pipeline = PIPELINES[pipeline_name]
+    rss_before = peak_rss_bytes()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        mask = pipeline(canvas_result, output_size)
+        timings.append(time.perf_counter() - started)
+        del mask
+    queue.put((min(timings), peak_rss_bytes() - rss_before))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'size':<6}{'pipeline':<12}{'best time (ms)':>16}{'peak RSS growth (MB)':>24}")
+    for size_name in SIZES:
+        for pipeline_name in PIPELINES:
+            queue = context.Queue()
+            process = context.Process(target=run_case, args=(pipeline_name, size_name, args.repeat, queue))
+            process.start()
+            best, rss_growth = queue.get()
+            process.join()
+            print(f"{size_name:<6}{pipeline_name:<12}{best * 1000:>16.1f}{rss_growth / 2**20:>24.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# Startup and rerun cost of the Streamlit app, measured end to end.
+#
+# Starts `streamlit run app.py` headless in a scratch directory, connects over the same
+# websocket the browser uses and times:
+#   first paint  connect -> first rendered element of the first session (cold process:
+#                includes the app's own imports and top-level setup)
+#   first run    connect -> script finished for that session
+#   rerun        rerun request -> script finished, repeated on a warm process
+# The end-to-end numbers include a fixed Streamlit round trip (~100 ms here even for a
+# one-line app), so the app's own share is also read back from the server's metrics log:
+#   script_run   the stage_seconds{stage="script_run"} timings of the first and later runs
+#
+# Run it on two checkouts to compare before/after:
+#   python -m benchmarks.bench_startup --runs 5 --reruns 20 --save startup.json
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Static files the app reads relative to its working directory
+APP_FILES = ("style.css", "assets")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def prepare_workdir(workdir):
+    for name in APP_FILES:
+        os.symlink(os.path.join(REPO_DIR, name), os.path.join(workdir, name))
+    # st.secrets also reads ~/.streamlit/secrets.toml; HOME points at the scratch directory
+    os.makedirs(os.path.join(workdir, ".streamlit"))
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w") as file:
+        file.write('STABILITY_AI = "benchmark-key"\n')
+
+
+def wait_until_healthy(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("streamlit server did not come up")
+
+
+def rerun_message():
+    message = BackMsg()
+    message.rerun_script.query_string = ""
+    return message.SerializeToString()
+
+
+async def run_session(port, reruns):
+    # One browser session: the initial run happens on connect, later ones on request
+    started = time.perf_counter()
+    connection = await websocket_connect(f"ws://127.0.0.1:{port}/_stcore/stream")
+    first_paint = None
+    first_run = None
+    rerun_times = []
+    rerun_started = None
+    await connection.write_message(rerun_message(), binary=True)
+    while True:
+        data = await connection.read_message()
+        if data is None:
+            raise RuntimeError("streamlit closed the connection")
+        message = ForwardMsg()
+        message.ParseFromString(data)
+        kind = message.WhichOneof("type")
+        now = time.perf_counter()
+        if kind == "delta" and first_paint is None:
+            first_paint = now - started
+        elif kind == "script_finished":
+            if first_run is None:
+                first_run = now - started
+            else:
+                rerun_times.append(now - rerun_started)
+            if len(rerun_times) == reruns:
+                break
+            rerun_started = time.perf_counter()
+            await connection.write_message(rerun_message(), binary=True)
+    connection.close()
+    return first_paint, first_run, rerun_times
+
+
+def read_script_runs(log_path):
+    timings = []
+    if not os.path.exists(log_path):
+        return timings
+    with open(log_path) as file:
+        for line in file:
+            record = json.loads(line)
+            if record["name"] == "stage_seconds" and record.get("stage") == "script_run":
+                timings.append(record["value"])
+    return timings
+
+
+def measure(app, reruns):
+    # One cold server process: first session plus its reruns
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    prepare_workdir(workdir)
+    log_path = os.path.join(workdir, "metrics.jsonl")
+    env = dict(os.environ, HOME=workdir, METRICS_MODE="full", METRICS_LOG=log_path)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", app, "--server.headless", "true",
+         "--server.port", str(port), "--browser.gatherUsageStats", "false"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_healthy(port)
+        first_paint, first_run, rerun_times = IOLoop.current().run_sync(
+            lambda: run_session(port, reruns))
+    finally:
+        server.terminate()
+        server.wait()
+        script_runs = read_script_runs(log_path)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "first_paint_ms": first_paint * 1000,
+        "first_run_ms": first_run * 1000,
+        "rerun_median_ms": statistics.median(rerun_times) * 1000,
+        "first_script_run_ms": script_runs[0] * 1000 if script_runs else None,
+        "rerun_script_run_ms": statistics.median(script_runs[1:]) * 1000 if len(script_runs) > 1 else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure Streamlit first paint and rerun time.")
+    parser.add_argument("--app", default=os.path.join(REPO_DIR, "app.py"))
+    parser.add_argument("--runs", type=int, default=5, help="cold server starts to take the median of")
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--save", help="write results as JSON")
+    args = parser.parse_args(argv)
+
+    runs = [measure(args.app, args.reruns) for _ in range(args.runs)]
+    results = {}
+    for name in runs[0]:
+        values = [run[name] for run in runs if run[name] is not None]
+        results[name] = statistics.median(values) if values else None
+    for name, value in results.items():
+        print(f"{name:<22}" + (f"{value:>10.1f}" if value is not None else f"{'n/a':>10}"))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
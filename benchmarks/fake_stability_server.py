@@ -0,0 +1,173 @@
+# Local stand-in for the Stability AI REST API, so StabilityAIClient can be
+# exercised without network access or paid credits. Latency (with jitter), the
+# fraction of failed calls and the output image size are configurable; with
+# output_size=None the response mirrors the size of the uploaded image, like the
+# real edit endpoints do. With key_concurrency each API key may have that many calls in
+# flight; more get a 429 with Retry-After, like a per-account rate limit. GET
+# /v1/user/balance answers with `credits`.
+#
+#   with FakeStabilityServer(latency=0.5) as server:
+#       client = StabilityAIClient("test-key", base_url=server.url)
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+ENDPOINTS = (
+    "/v2beta/stable-image/edit/inpaint",
+    "/v2beta/stable-image/edit/erase",
+    "/v2beta/stable-image/edit/search-and-replace",
+    "/v2beta/stable-image/control/structure",
+)
+
+
+class FakeStabilityServer:
+    def __init__(self, latency=0.0, output_size=(64, 64), scripted_statuses=None, latency_jitter=0.0,
+                 error_rate=0.0, seed=0, key_concurrency=None, credits=100.0, retry_after=1,
+                 host="127.0.0.1", port=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.output_size = output_size
+        self._outputs = {}
+        # Statuses (or (status, headers) tuples) to answer with before falling back to 200
+        self.scripted_statuses = list(scripted_statuses or [])
+        self.key_concurrency = key_concurrency
+        self.credits = credits
+        self.retry_after = retry_after
+        self.hits = {}
+        self.key_hits = {}
+        self.throttled = 0
+        self._key_in_flight = {}
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, headers, body):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != "/v1/user/balance":
+                    self._reply(404, {"Content-Type": "application/json"}, b'{"errors": ["not found"]}')
+                    return
+                self._reply(200, {"Content-Type": "application/json"}, f'{{"credits": {server.credits}}}'.encode())
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request_body = self.rfile.read(length)
+                api_key = self.headers.get("Authorization", "").removeprefix("Bearer ")
+                if not server._enter_key(api_key):
+                    self._reply(429, {"Content-Type": "application/json", "Retry-After": str(server.retry_after)},
+                                b'{"errors": ["rate limited"]}')
+                    return
+                try:
+                    status, headers, body = server._next_response(
+                        self.path, self.headers.get("Content-Type", ""), request_body)
+                finally:
+                    server._leave_key(api_key)
+                self._reply(status, headers, body)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def total_hits(self):
+        with self.lock:
+            return sum(self.hits.values())
+
+    def _enter_key(self, api_key):
+        with self.lock:
+            in_flight = self._key_in_flight.get(api_key, 0)
+            if self.key_concurrency is not None and in_flight >= self.key_concurrency:
+                self.throttled += 1
+                return False
+            self._key_in_flight[api_key] = in_flight + 1
+            self.key_hits[api_key] = self.key_hits.get(api_key, 0) + 1
+            return True
+
+    def _leave_key(self, api_key):
+        with self.lock:
+            self._key_in_flight[api_key] -= 1
+
+    def _render_output(self, size):
+        # Outputs are cached per size so rendering doesn't skew latency measurements
+        with self.lock:
+            output = self._outputs.get(size)
+        if output is None:
+            buffer = BytesIO()
+            Image.new("RGB", size, (200, 180, 150)).save(buffer, format="PNG", compress_level=1)
+            output = buffer.getvalue()
+            with self.lock:
+                self._outputs[size] = output
+        return output
+
+    def _uploaded_image_size(self, content_type, body):
+        # Minimal multipart parsing: find the "image" part and read its header
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not match:
+            return None
+        for part in body.split(b"--" + match.group(1).encode()):
+            head, _, payload = part.partition(b"\r\n\r\n")
+            if b'name="image"' in head:
+                try:
+                    return Image.open(BytesIO(payload)).size
+                except Exception:
+                    return None
+        return None
+
+    def _next_response(self, path, content_type, body):
+        with self.lock:
+            self.hits[path] = self.hits.get(path, 0) + 1
+            scripted = self.scripted_statuses.pop(0) if self.scripted_statuses else None
+            delay = self.latency + self.random.uniform(0, self.latency_jitter)
+            failed = self.random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if path not in ENDPOINTS:
+            return 404, {"Content-Type": "application/json"}, b'{"errors": ["not found"]}'
+        if scripted is not None:
+            status, headers = scripted if isinstance(scripted, tuple) else (scripted, {})
+            if status != 200:
+                headers = dict(headers, **{"Content-Type": "application/json"})
+                return status, headers, b'{"errors": ["scripted failure"]}'
+        elif failed:
+            return 500, {"Content-Type": "application/json"}, b'{"errors": ["injected failure"]}'
+        size = self.output_size or self._uploaded_image_size(content_type, body) or (64, 64)
+        return 200, {"Content-Type": "image/png"}, self._render_output(size)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
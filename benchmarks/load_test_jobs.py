@@ -0,0 +1,95 @@
+# Load test for JobExecutor: N simulated sessions submit a generation against a slow
+# fake endpoint and poll for the result the way the Streamlit page does. With enough
+# workers the wall time should be close to one upstream latency, not N of them.
+# With --identical every session submits the same request, and the client's
+# single-flight coalescing must turn them into exactly one upstream call.
+#
+#   python -m benchmarks.load_test_jobs --sessions 16 --latency 1.0
+#   python -m benchmarks.load_test_jobs --sessions 16 --identical
+#
+# --key-concurrency makes the fake API throttle each key past that many calls in flight;
+# compare --keys 1 with --keys 4 to see the key pool spread the load:
+#
+#   python -m benchmarks.load_test_jobs --sessions 16 --key-concurrency 4 --keys 4
+import argparse
+import sys
+import threading
+import time
+
+from PIL import Image
+
+from api_client import StabilityAIClient
+from job_queue import JobExecutor
+from benchmarks.fake_stability_server import FakeStabilityServer
+
+
+def simulate_session(executor, client, image, mask, seed, poll_interval, latencies):
+    started = time.perf_counter()
+    job_id = executor.submit(
+        client.inpaint_image, "a sofa", None, image, mask, seed=seed, rate_key=client.api_key)
+    while not executor.get(job_id).finished:
+        time.sleep(poll_interval)
+    job = executor.pop(job_id)
+    if job.error is not None or job.result.status_code != 200:
+        raise RuntimeError(f"Job {job_id} failed: {job.error or job.result.status_code}")
+    latencies.append(time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=1.0, help="fake upstream latency in seconds")
+    parser.add_argument("--rate", type=float, default=100, help="requests per second per API key")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--identical", action="store_true",
+                        help="submit the same request from every session and expect one upstream hit")
+    parser.add_argument("--keys", type=int, default=1, help="API keys in the client's key pool")
+    parser.add_argument("--key-concurrency", type=int, default=None,
+                        help="calls in flight per key before the fake API answers 429")
+    args = parser.parse_args()
+
+    image = Image.new("RGB", (512, 512), (120, 120, 120))
+    mask = Image.new("L", (512, 512), 255)
+    latencies = []
+
+    with FakeStabilityServer(latency=args.latency, key_concurrency=args.key_concurrency) as server:
+        api_keys = [f"load-test-key-{index}" for index in range(args.keys)]
+        client = StabilityAIClient(api_keys, base_url=server.url, pool_size=args.workers, max_retries=20)
+        executor = JobExecutor(max_workers=args.workers, requests_per_second=args.rate, burst=args.sessions)
+        sessions = [
+            threading.Thread(
+                target=simulate_session,
+                args=(executor, client, image, mask, 1 if args.identical else index + 1,
+                      args.poll_interval, latencies))
+            for index in range(args.sessions)
+        ]
+        started = time.perf_counter()
+        for session in sessions:
+            session.start()
+        for session in sessions:
+            session.join()
+        wall_time = time.perf_counter() - started
+        executor.shutdown()
+        client.close()
+        upstream_hits = server.total_hits
+        throttled = server.throttled
+        key_stats = client.key_stats()
+
+    print(f"sessions:          {args.sessions} ({len(latencies)} completed)")
+    print(f"upstream latency:  {args.latency:.2f}s")
+    print(f"wall time:         {wall_time:.2f}s")
+    print(f"sum of latencies:  {args.sessions * args.latency:.2f}s (serial)")
+    print(f"max session time:  {max(latencies):.2f}s")
+    print(f"upstream hits:     {upstream_hits}")
+    print(f"throttled (429):   {throttled}")
+    for stats in key_stats:
+        print(f"  {stats['key']}: {stats['successes']} ok, {stats['throttled']} throttled")
+    if args.identical and upstream_hits != 1:
+        print("FAIL: identical requests were not coalesced into one upstream call")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+# Reproducible generation benchmarks against the local fake Stability API.
+#
+# Scenarios:
+#   client    StabilityAIClient.inpaint_image round trips (upload encode + HTTP + spool)
+#   mask      build_mask_from_canvas at the target image size
+#   pipeline  handle_image_generation run headlessly: mask build and archive encode,
+#             crop_to_mask, upload, decode and composite via generate_region
+#
+# Every (scenario, size, concurrency) case runs in a fresh process, so its peak RSS is
+# its own. Results can be saved as a JSON baseline and compared against on later runs:
+#
+#   python -m benchmarks.run_benchmarks --save benchmarks/baseline.json
+#   python -m benchmarks.run_benchmarks --compare benchmarks/baseline.json
+import argparse
+import json
+import multiprocessing
+import platform
+import queue as queue_module
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from api_client import StabilityAIClient
+from image_codec import encode_image
+from image_processing import build_mask_from_canvas, crop_to_mask, generate_region
+from prompts import item_prompts
+from benchmarks.bench_mask import FakeCanvasResult, make_canvas
+from benchmarks.fake_stability_server import FakeStabilityServer
+
+SCENARIOS = ("client", "mask", "pipeline")
+CANVAS_WIDTH = 1000
+
+
+def parse_size(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def make_region_canvas(output_size):
+    # A furniture-sized stroke in the lower middle of the room, like a typical "Add Item"
+    height = int(output_size[1] * CANVAS_WIDTH / output_size[0])
+    image_data = np.zeros((height, CANVAS_WIDTH, 4), dtype=np.uint8)
+    cv2.rectangle(image_data, (CANVAS_WIDTH // 3, height // 2), (2 * CANVAS_WIDTH // 3, 5 * height // 6),
+                  (255, 255, 255, 77), -1)
+    return FakeCanvasResult(image_data)
+
+
+def make_room(size):
+    rng = np.random.default_rng(0)
+    # Noise keeps PNG encoding costs close to a real photo's
+    return Image.fromarray(rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_mb():
+    # VmHWM resets on exec, unlike ru_maxrss, which a spawned child inherits from the
+    # (server-hosting) parent it was forked from
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(scenario, size, concurrency, requests, base_url, queue):
+    prompt = item_prompts["Sofa"]["prompt"]
+    negative_prompt = item_prompts["Sofa"]["negative_prompt"]
+    client = StabilityAIClient("benchmark-key", base_url=base_url, pool_size=concurrency, coalesce=False,
+                               backoff_factor=0.05)
+    room = make_room(size)
+
+    if scenario == "client":
+        mask = Image.new("L", size, 0)
+
+        def operation(index):
+            result = client.inpaint_image(prompt, negative_prompt, room, mask, seed=index + 1)
+            result.content
+            return result.ok
+    elif scenario == "mask":
+        canvas_result = make_canvas(size)
+
+        def operation(index):
+            build_mask_from_canvas(canvas_result, size)
+            return True
+    else:
+        canvas_result = make_region_canvas(size)
+
+        def operation(index):
+            mask_image = build_mask_from_canvas(canvas_result, size)
+            encode_image(mask_image, "png")
+            crop_image, crop_mask, box = crop_to_mask(room, mask_image)
+            crop_mask_bytes = encode_image(crop_mask, "png")
+            _, output_image = generate_region(
+                client.inpaint_image, room, mask_image, box,
+                prompt=prompt, negative_prompt=negative_prompt,
+                image=crop_image, mask=crop_mask_bytes, seed=index + 1)
+            return output_image is not None
+
+    latencies = []
+    errors = 0
+
+    def timed(index):
+        started = time.perf_counter()
+        ok = operation(index)
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for latency, ok in pool.map(timed, range(requests)):
+            latencies.append(latency)
+            errors += 0 if ok else 1
+    wall_time = time.perf_counter() - started
+    client.close()
+
+    queue.put({
+        "throughput": requests / wall_time,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "errors": errors,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+
+
+def wait_for_case(process, queue, timeout):
+    # The case's result, or a failure record if the process dies or runs past timeout
+    # without reporting one (e.g. it raised), instead of blocking on the queue forever
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except queue_module.Empty:
+            pass
+        if not process.is_alive():
+            # It may have put its result just before exiting
+            try:
+                return queue.get(timeout=1)
+            except queue_module.Empty:
+                return {"failed": f"exited with code {process.exitcode} without a result"}
+        if time.monotonic() > deadline:
+            process.terminate()
+            return {"failed": f"no result after {timeout:.0f}s"}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if "failed" in result:
+            regressions.append(f"{key}: failed ({result['failed']})")
+            continue
+        if "failed" in base:
+            continue
+        if result["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {base['p95'] * 1000:.1f} -> {result['p95'] * 1000:.1f} ms")
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {base['throughput']:.2f} -> {result['throughput']:.2f} ops/s")
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{key}: peak RSS {base['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark generation against a local fake Stability API.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--sizes", default="1024x768,3840x2160")
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--requests", type=int, default=32, help="operations per case")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake upstream latency in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--output-size", type=parse_size, default=None,
+                        help="fixed output size; defaults to mirroring the uploaded image")
+    parser.add_argument("--save", help="write results as a JSON baseline")
+    parser.add_argument("--compare", help="JSON baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--case-timeout", type=float, default=900, help="seconds before a case counts as failed")
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenarios.split(",")
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    levels = [int(level) for level in args.concurrency.split(",")]
+    context = multiprocessing.get_context("spawn")
+    results = {}
+
+    print(f"{'case':<28}{'ops/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'RSS MB':>9}")
+    with FakeStabilityServer(latency=args.latency, latency_jitter=args.latency_jitter,
+                             error_rate=args.error_rate, output_size=args.output_size) as server:
+        for scenario in scenarios:
+            for size in sizes:
+                for concurrency in levels:
+                    key = f"{scenario}/{size[0]}x{size[1]}/c{concurrency}"
+                    queue = context.Queue()
+                    process = context.Process(
+                        target=run_case, args=(scenario, size, concurrency, args.requests, server.url, queue))
+                    process.start()
+                    result = wait_for_case(process, queue, args.case_timeout)
+                    process.join()
+                    results[key] = result
+                    if "failed" in result:
+                        print(f"{key:<28}FAILED: {result['failed']}")
+                        continue
+                    print(f"{key:<28}{result['throughput']:>9.2f}{result['p50'] * 1000:>10.1f}"
+                          f"{result['p95'] * 1000:>10.1f}{result['p99'] * 1000:>10.1f}{result['errors']:>8}"
+                          f"{result['peak_rss_mb']:>9.0f}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({
+                "environment": {"python": platform.python_version(), "platform": platform.platform()},
+                "settings": {key: value for key, value in vars(args).items() if key not in ("save", "compare")},
+                "results": results,
+            }, file, indent=2)
+        print(f"saved baseline to {args.save}")
+
+    failed = [key for key, result in results.items() if "failed" in result]
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("no regressions against baseline")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+import numpy as np
+import streamlit.elements.image as st_image
+from PIL import Image
+from streamlit_drawable_canvas import CanvasResult, _component_func, _data_url_to_image
+
+from image_codec import encode_image
+
+
+def render_canvas_background(image, max_width=1000):
+    # Downscale for the canvas preview and encode it once. reducing_gap lets PIL do a
+    # cheap integer reduce() before the bilinear pass, which is much faster on large photos.
+    original_width, original_height = image.size
+    if original_width > max_width:
+        scaling_factor = max_width / original_width
+        canvas_width = max_width
+        canvas_height = int(original_height * scaling_factor)
+        preview = image.resize((canvas_width, canvas_height), Image.BILINEAR, reducing_gap=2.0)
+    else:
+        canvas_width, canvas_height = original_width, original_height
+        preview = image
+    return canvas_width, canvas_height, encode_image(preview.convert("RGB"), "png")
+
+
+def st_canvas_with_background(background_png, background_id, width, height, fill_color, stroke_width,
+                              stroke_color, drawing_mode="freedraw", key=None):
+    # Mirrors streamlit_drawable_canvas.st_canvas (0.9.0), but takes the background as
+    # PNG bytes that are already at canvas size. st_canvas resizes, hashes and re-encodes
+    # its background_image on every rerun; here an unchanged background costs neither, and
+    # the component keeps receiving the same URL so the browser doesn't refetch it.
+    background_image_url = st_image.image_to_url(
+        background_png, width, True, "RGB", "PNG", f"drawable-canvas-bg-{background_id}-{key}"
+    )
+    component_value = _component_func(
+        fillColor=fill_color,
+        strokeWidth=stroke_width,
+        strokeColor=stroke_color,
+        backgroundColor="",
+        backgroundImageURL=background_image_url,
+        realtimeUpdateStreamlit=drawing_mode != "polygon",
+        canvasHeight=height,
+        canvasWidth=width,
+        drawingMode=drawing_mode,
+        initialDrawing={"version": "4.4.0", "background": ""},
+        displayToolbar=True,
+        displayRadius=3,
+        key=key,
+        default=None,
+    )
+    if component_value is None:
+        return CanvasResult
+
+    return CanvasResult(
+        np.asarray(_data_url_to_image(component_value["data"])),
+        component_value["raw"],
+    )
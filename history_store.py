@@ -0,0 +1,195 @@
+import hashlib
+import itertools
+import threading
+import weakref
+from io import BytesIO
+
+from PIL import Image
+
+from image_codec import encode_image
+
+_sequence = itertools.count()
+
+
+class Snapshot:
+    # One image kept as compressed bytes, decoded only when it is needed. With a blob
+    # store the bytes live there (deduplicated by digest) and the snapshot holds no image
+    # data in memory; budgets still count its nbytes, so they bound the blobs it keeps alive.
+    def __init__(self, digest, nbytes, data=None, blob_store=None):
+        self.digest = digest
+        self.nbytes = nbytes
+        self.sequence = next(_sequence)
+        self._data = data
+        self.blob_store = blob_store
+
+    @classmethod
+    def from_image(cls, image, image_format="png", blob_store=None):
+        data = encode_image(image, image_format)
+        if blob_store is not None:
+            return cls(blob_store.put(data), len(data), blob_store=blob_store)
+        return cls(hashlib.sha256(data).hexdigest(), len(data), data=data)
+
+    @property
+    def data(self):
+        if self._data is not None:
+            return self._data
+        return self.blob_store.get(self.digest)
+
+    def decode(self):
+        image = Image.open(BytesIO(self.data))
+        image.load()
+        return image
+
+    def to_state(self):
+        return [self.digest, self.nbytes]
+
+    @classmethod
+    def from_state(cls, state, blob_store):
+        digest, nbytes = state
+        return cls(digest, nbytes, blob_store=blob_store)
+
+
+class MemoryBudget:
+    # Server-wide byte budget shared by every session's HistoryStore. When it is
+    # exceeded the oldest snapshot across all sessions is dropped first.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.stores = weakref.WeakSet()
+        self.lock = threading.RLock()
+
+    def register(self, store):
+        with self.lock:
+            self.stores.add(store)
+        # Give the bytes back when a session's store is garbage collected
+        weakref.finalize(store, self.release, store.usage)
+
+    def release(self, usage):
+        with self.lock:
+            self.total_bytes -= usage["bytes"]
+            usage["bytes"] = 0
+
+    def charge(self, nbytes):
+        with self.lock:
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                candidates = [store for store in self.stores if store.oldest() is not None]
+                if not candidates:
+                    break
+                oldest_store = min(candidates, key=lambda store: store.oldest().sequence)
+                oldest_store.evict_oldest()
+
+
+class HistoryStore:
+    # Undo/redo stacks of Snapshots for one session. Budgets count the compressed bytes of
+    # every snapshot, whether held in memory or in the blob store; the oldest steps are
+    # evicted once max_bytes (or the shared budget) is exceeded, or once there are more
+    # than max_steps of them.
+    def __init__(self, max_bytes=200 * 1024 * 1024, budget=None, image_format="png", blob_store=None,
+                 max_steps=None):
+        self.max_bytes = max_bytes
+        self.budget = budget
+        self.image_format = image_format
+        self.blob_store = blob_store
+        self.max_steps = max_steps
+        self.undo_stack = []
+        self.redo_stack = []
+        # Kept in a dict so the budget's finalizer can read it after the store is gone
+        self.usage = {"bytes": 0}
+        # Share the budget's lock so evictions across sessions can't deadlock
+        self.lock = budget.lock if budget is not None else threading.RLock()
+        if budget is not None:
+            budget.register(self)
+
+    def __len__(self):
+        return len(self.undo_stack)
+
+    @property
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    @property
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def stored_bytes(self):
+        return self.usage["bytes"]
+
+    def snapshot(self, image):
+        # Compress an image with this store's settings
+        return Snapshot.from_image(image, self.image_format, self.blob_store)
+
+    def _push(self, stack, snapshot):
+        with self.lock:
+            stack.append(snapshot)
+            self.usage["bytes"] += snapshot.nbytes
+            while self.oldest() is not None and (
+                    self.usage["bytes"] > self.max_bytes
+                    or (self.max_steps is not None
+                        and len(self.undo_stack) + len(self.redo_stack) > self.max_steps)):
+                self.evict_oldest()
+        if self.budget is not None:
+            self.budget.charge(snapshot.nbytes)
+
+    def _pop(self, stack):
+        with self.lock:
+            snapshot = stack.pop()
+            self._uncharge(snapshot)
+        return snapshot
+
+    def _uncharge(self, snapshot):
+        self.usage["bytes"] -= snapshot.nbytes
+        if self.budget is not None:
+            self.budget.total_bytes -= snapshot.nbytes
+
+    def oldest(self):
+        # Undo steps furthest back go first, then the redo step furthest ahead
+        with self.lock:
+            if self.undo_stack:
+                return self.undo_stack[0]
+            if self.redo_stack:
+                return self.redo_stack[0]
+            return None
+
+    def evict_oldest(self):
+        with self.lock:
+            stack = self.undo_stack if self.undo_stack else self.redo_stack
+            if stack:
+                self._uncharge(stack.pop(0))
+
+    def push(self, snapshot):
+        # Record the snapshot that a new edit is about to replace
+        self._push(self.undo_stack, snapshot)
+
+    def undo(self, current):
+        previous = self._pop(self.undo_stack)
+        self._push(self.redo_stack, current)
+        return previous
+
+    def redo(self, current):
+        following = self._pop(self.redo_stack)
+        self._push(self.undo_stack, current)
+        return following
+
+    def clear(self):
+        with self.lock:
+            for snapshot in self.undo_stack + self.redo_stack:
+                self._uncharge(snapshot)
+            self.undo_stack = []
+            self.redo_stack = []
+
+    def to_state(self):
+        with self.lock:
+            return {
+                "undo": [snapshot.to_state() for snapshot in self.undo_stack],
+                "redo": [snapshot.to_state() for snapshot in self.redo_stack],
+            }
+
+    def load_state(self, state):
+        # Restore persisted stacks; only possible for blob-backed stores
+        self.clear()
+        # Pushed oldest first, so restored steps are charged and evicted like new ones
+        for item in state["undo"]:
+            self._push(self.undo_stack, Snapshot.from_state(item, self.blob_store))
+        for item in state["redo"]:
+            self._push(self.redo_stack, Snapshot.from_state(item, self.blob_store))
@@ -0,0 +1,26 @@
+# Image encoding and the endpoints' input limits, kept apart from api_client so the page
+# and the image helpers can use them without importing requests and the client
+from io import BytesIO
+
+# Input limits of the v2beta edit/control endpoints: total pixels and shortest side
+MAX_INPUT_PIXELS = 9_437_184
+MIN_INPUT_SIDE = 64
+# Upload encodings the edit/control endpoints accept
+UPLOAD_CONTENT_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def encode_image(image, image_format="png", compress_level=1, quality=95):
+    # PNG at compress_level 1 is several times faster than PIL's default (6) on large
+    # photos for a modest size increase; WebP is encoded losslessly, JPEG at `quality`
+    buffer = BytesIO()
+    if image_format == "png":
+        image.save(buffer, format="PNG", compress_level=compress_level)
+    elif image_format == "webp":
+        image.save(buffer, format="WEBP", lossless=True, method=0)
+    elif image_format == "jpeg":
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(buffer, format="JPEG", quality=quality)
+    else:
+        raise ValueError(f"Unsupported upload format: {image_format}")
+    return buffer.getvalue()
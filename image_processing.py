@@ -1,20 +1,28 @@
 from PIL import Image
 import numpy as np
-from io import BytesIO
 import streamlit as st
-import cv2
-
-def preprocess_image(image_path, api_client):
-    prompt = "an oak wooden floor, some nice painting on the walls with a light tint"
-    negative_prompt = (
-        "Avoid altering the existing walls or introducing new structural elements. "
-        "Ensure all furniture is appropriately scaled to the room’s dimensions. "
-        "Exclude any deformed structures, incorrect ratios, or anatomically incorrect objects."
-    )
-    response = api_client.search_and_replace_image(prompt, negative_prompt, image_path)
+
+from image_codec import MAX_INPUT_PIXELS, MIN_INPUT_SIDE
+from metrics import registry as metrics
+
+# Pixel budget of the fast preview pass; its result is scaled back up to the crop box
+PREVIEW_PIXELS = 512 * 512
+
+# cv2 is imported inside the functions that use it: it costs tens of milliseconds at
+# startup and is only needed once a mask is built or a result composited
+
+# Search-and-replace prompts used by preprocess_image
+PREPROCESS_PROMPT = "an oak wooden floor, some nice painting on the walls with a light tint"
+PREPROCESS_NEGATIVE_PROMPT = (
+    "Avoid altering the existing walls or introducing new structural elements. "
+    "Ensure all furniture is appropriately scaled to the room’s dimensions. "
+    "Exclude any deformed structures, incorrect ratios, or anatomically incorrect objects."
+)
+
+def preprocess_image(image, api_client):
+    response = api_client.search_and_replace_image(PREPROCESS_PROMPT, PREPROCESS_NEGATIVE_PROMPT, image)
     if response.status_code == 200:
-        output_image = Image.open(BytesIO(response.content))
-        return output_image
+        return response.image
     else:
         st.error(f"Error: {response.status_code} - {response.text}")
         return None
@@ -22,6 +30,8 @@ def preprocess_image(image_path, api_client):
 
 
 def create_mask_from_canvas(canvas_result):
+    import cv2
+
     # Get the canvas image data
     canvas_data = canvas_result.image_data  # This is a numpy array with shape (height, width, 4)
 
@@ -43,4 +53,139 @@ def create_mask_from_canvas(canvas_result):
     # Convert mask to PIL Image
     mask_image = Image.fromarray(mask, mode='L')
 
-    return mask_image
\ No newline at end of file
+    return mask_image
+
+def build_mask_from_canvas(canvas_result, output_size=None, dilation=0, feather=0):
+    import cv2
+
+    # Same mask as create_mask_from_canvas, built with fewer full-size copies:
+    # threshold, hole filling, dilation and feathering all run in place at canvas
+    # resolution, then a single cv2.resize produces the output-size mask.
+    # dilation and feather are in canvas pixels.
+    alpha_channel = canvas_result.image_data[:, :, 3]
+
+    # The only canvas-size copy: cv2 needs a contiguous uint8 array
+    mask = np.ascontiguousarray(alpha_channel, dtype=np.uint8)
+    cv2.threshold(mask, 0, 255, cv2.THRESH_BINARY, dst=mask)
+
+    # Fill the outer contours directly into the strokes to close any holes
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cv2.drawContours(mask, contours, -1, 255, thickness=cv2.FILLED)
+
+    if dilation > 0:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * dilation + 1, 2 * dilation + 1))
+        cv2.dilate(mask, kernel, dst=mask)
+    if feather > 0:
+        cv2.GaussianBlur(mask, (2 * feather + 1, 2 * feather + 1), 0, dst=mask)
+
+    if output_size is not None and output_size != (mask.shape[1], mask.shape[0]):
+        # Nearest keeps hard masks binary; a feathered mask is interpolated smoothly
+        interpolation = cv2.INTER_LINEAR if feather > 0 else cv2.INTER_NEAREST
+        mask = cv2.resize(mask, output_size, interpolation=interpolation)
+
+    return Image.fromarray(mask, mode='L')
+
+
+def load_image(source, max_pixels=MAX_INPUT_PIXELS):
+    # Open an upload at no more than max_pixels. JPEGs are decoded straight at a reduced
+    # scale with draft() (1/2, 1/4 or 1/8, never below the target), so a 48 MP phone
+    # photo is never fully decoded just to be thrown away.
+    image = Image.open(source)
+    width, height = image.size
+    if width * height <= max_pixels:
+        return image.convert('RGB')
+
+    scale = (max_pixels / (width * height)) ** 0.5
+    target_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    if image.format == 'JPEG':
+        image.draft('RGB', target_size)
+    image = image.convert('RGB')
+    if image.size != target_size:
+        image = image.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+    return image
+
+
+def crop_to_mask(image, mask_image, margin=0.25, min_margin=64, max_pixels=None):
+    # Bounding box of the mask plus some surrounding context, so inpaint/erase only
+    # upload (and pay compute for) the region being edited. Returns the cropped image,
+    # cropped mask and the box in original coordinates; an empty mask keeps the full frame.
+    width, height = image.size
+    bbox = mask_image.getbbox()
+    if bbox is None:
+        return image, mask_image, (0, 0, width, height)
+
+    left, top, right, bottom = bbox
+    margin_x = max(min_margin, int((right - left) * margin))
+    margin_y = max(min_margin, int((bottom - top) * margin))
+    left, top = max(0, left - margin_x), max(0, top - margin_y)
+    right, bottom = min(width, right + margin_x), min(height, bottom + margin_y)
+
+    # Respect the endpoint's minimum side length where the image allows it
+    if right - left < MIN_INPUT_SIDE:
+        left = max(0, min(left, width - MIN_INPUT_SIDE))
+        right = min(width, left + MIN_INPUT_SIDE)
+    if bottom - top < MIN_INPUT_SIDE:
+        top = max(0, min(top, height - MIN_INPUT_SIDE))
+        bottom = min(height, top + MIN_INPUT_SIDE)
+
+    box = (left, top, right, bottom)
+    crop_image = image.crop(box)
+    crop_mask = mask_image.crop(box)
+    # The upload is downscaled if needed; composite_region scales the result back up to box
+    max_pixels = max_pixels or MAX_INPUT_PIXELS
+    crop_pixels = crop_image.size[0] * crop_image.size[1]
+    if crop_pixels > max_pixels:
+        scale = (max_pixels / crop_pixels) ** 0.5
+        size = (int(crop_image.size[0] * scale), int(crop_image.size[1] * scale))
+        crop_image = crop_image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        crop_mask = crop_mask.resize(size, Image.NEAREST)
+    return crop_image, crop_mask, box
+
+
+def downscale_for_preview(crop_image, crop_mask, max_pixels=PREVIEW_PIXELS):
+    # Shrink a crop_to_mask region for the low-resolution preview pass. Sides stay at or
+    # above the endpoint's minimum where the crop allows it.
+    width, height = crop_image.size
+    scale = (max_pixels / (width * height)) ** 0.5
+    if scale >= 1:
+        return crop_image, crop_mask
+    size = (min(width, max(MIN_INPUT_SIDE, round(width * scale))),
+            min(height, max(MIN_INPUT_SIDE, round(height * scale))))
+    preview_image = crop_image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    preview_mask = crop_mask.resize(size, Image.NEAREST)
+    return preview_image, preview_mask
+
+
+def composite_region(original, result, mask_image, box):
+    import cv2
+
+    # Paste a generated crop back into the full-resolution original. The mask is grown
+    # and softened slightly so the generated pixels blend into the untouched ones.
+    left, top, right, bottom = box
+    size = (right - left, bottom - top)
+    if result.size != size:
+        result = result.resize(size, Image.LANCZOS)
+    if result.mode != original.mode:
+        result = result.convert(original.mode)
+
+    blend_mask = np.array(mask_image.crop(box), dtype=np.uint8)
+    radius = max(2, min(size) // 100)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+    cv2.dilate(blend_mask, kernel, dst=blend_mask)
+    cv2.GaussianBlur(blend_mask, (2 * radius + 1, 2 * radius + 1), 0, dst=blend_mask)
+
+    output_image = original.copy()
+    output_image.paste(result, (left, top), Image.fromarray(blend_mask, mode='L'))
+    return output_image
+
+
+def generate_region(generate_fn, original, mask_image, box, **kwargs):
+    # Run an inpaint/erase call on a region from crop_to_mask (kwargs carry the cropped
+    # image/mask uploads) and composite the result back into the full-resolution original.
+    # Returns the GenerationResult and the composited image, or None if the call failed.
+    response = generate_fn(**kwargs)
+    if response.status_code != 200:
+        return response, None
+    with metrics.stage("decode_composite"):
+        output_image = composite_region(original, response.image, mask_image, box)
+    return response, output_image
@@ -0,0 +1,181 @@
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class RateLimiter:
+    # Token bucket: allows `rate` calls per second on average with bursts of up to `burst`
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self):
+        # Take a token if one is available right now, without waiting, e.g. for spend caps
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def refund(self):
+        # Give back a token taken by try_acquire() for a call that was not made after all
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class Job:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = False
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+
+class JobExecutor:
+    # Process-wide thread pool that Streamlit sessions hand generation work to, so the
+    # script thread only records a job id and polls instead of blocking on the upstream call.
+    # Concurrency is capped by max_workers and each API key gets its own rate limiter.
+    def __init__(self, max_workers=4, requests_per_second=10, burst=None, finished_ttl=600, name="generation"):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        # Results nobody collected (closed tabs) are dropped after this many seconds
+        self.finished_ttl = finished_ttl
+        self.jobs = {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def _limiter(self, rate_key):
+        if rate_key is None or not self.requests_per_second:
+            return None
+        with self.lock:
+            limiter = self.limiters.get(rate_key)
+            if limiter is None:
+                limiter = RateLimiter(self.requests_per_second, self.burst)
+                self.limiters[rate_key] = limiter
+            return limiter
+
+    def _prune(self):
+        cutoff = time.time() - self.finished_ttl
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and job.finished_at < cutoff:
+                del self.jobs[job_id]
+
+    def _run(self, job, limiter, fn, args, kwargs):
+        if limiter is not None and not job.cancelled:
+            limiter.acquire()
+        if job.cancelled:
+            # Cancelled while queued: the call is never made
+            job.status = CANCELLED
+            job.finished_at = time.time()
+            return
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            job.result = fn(*args, **kwargs)
+            job.status = DONE
+        except Exception as e:
+            job.error = e
+            job.status = FAILED
+        finally:
+            if job.cancelled:
+                # Nobody is waiting for it any more, so don't hold on to the result
+                job.result = None
+                job.status = CANCELLED
+            job.finished_at = time.time()
+
+    def submit(self, fn, *args, rate_key=None, **kwargs):
+        job = Job(uuid.uuid4().hex)
+        with self.lock:
+            self._prune()
+            self.jobs[job.id] = job
+        self.pool.submit(self._run, job, self._limiter(rate_key), fn, args, kwargs)
+        return job.id
+
+    def submit_many(self, calls, max_parallel=None, rate_key=None):
+        # Fan out (fn, args, kwargs) calls with at most max_parallel of them in the pool at
+        # once; the rest wait in a local queue and are fed in as earlier ones finish, so a
+        # large batch never occupies every worker. Returns the job ids in call order.
+        pending = deque()
+        job_ids = []
+        with self.lock:
+            self._prune()
+            for fn, args, kwargs in calls:
+                job = Job(uuid.uuid4().hex)
+                self.jobs[job.id] = job
+                pending.append((job, fn, args, kwargs))
+                job_ids.append(job.id)
+        limiter = self._limiter(rate_key)
+        pending_lock = threading.Lock()
+
+        def submit_next(_future=None):
+            with pending_lock:
+                if not pending:
+                    return
+                job, fn, args, kwargs = pending.popleft()
+            future = self.pool.submit(self._run, job, limiter, fn, args, kwargs)
+            future.add_done_callback(submit_next)
+
+        for _ in range(min(max_parallel or len(pending), len(pending))):
+            submit_next()
+        return job_ids
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def pop(self, job_id):
+        # Hand a finished job over to its session and forget it
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.finished:
+                del self.jobs[job_id]
+            return job
+
+    def cancel(self, job_id):
+        # Queued jobs are skipped when their turn comes. A call already in flight can't be
+        # recalled, but its result is dropped. Either way the job is forgotten right away.
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+        if job is not None:
+            job.cancelled = True
+        return job
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
@@ -0,0 +1,134 @@
+import threading
+import time
+
+
+class KeyState:
+    def __init__(self, key):
+        self.key = key
+        # Safe to show in metrics and the UI
+        self.label = f"{key[:3]}...{key[-4:]}" if len(key) > 12 else f"key-{len(key)}"
+        self.in_flight = 0
+        self.requests = 0
+        self.successes = 0
+        self.throttled = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.credits = None  # Unknown until the balance is refreshed
+        self.cooldown_until = 0.0
+        self.credits_retry_at = 0.0  # When a key known to be out of credits gets another try
+
+
+class KeyPool:
+    # API keys that requests are spread over: each attempt takes the key in rotation with
+    # the fewest requests in flight. A 429 takes a key out of rotation for its Retry-After
+    # (or `cooldown`) seconds. A key known to be out of credits (a 402, or a refreshed
+    # balance at or below min_credits) stays out until a refresh shows credits again, or
+    # for credit_cooldown seconds, after which it gets another try in case it was topped
+    # up. The client retries a request that got a 429 or a 402 on another key right away,
+    # as long as one is still in rotation. Keys can be given as a list or a comma-separated
+    # string.
+    def __init__(self, api_keys, cooldown=30, min_credits=0, credit_cooldown=600):
+        if isinstance(api_keys, str):
+            api_keys = api_keys.split(",")
+        keys = [key.strip() for key in api_keys if key.strip()]
+        if not keys:
+            raise ValueError("No API keys given")
+        self.keys = list(dict.fromkeys(keys))
+        self.states = {key: KeyState(key) for key in self.keys}
+        self.cooldown = cooldown
+        self.min_credits = min_credits
+        self.credit_cooldown = credit_cooldown
+        self.created_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def label(self, key):
+        return self.states[key].label
+
+    def _out_of_credits(self, state, now):
+        return (state.credits is not None and state.credits <= self.min_credits
+                and state.credits_retry_at > now)
+
+    def _in_rotation(self, state, now):
+        return state.cooldown_until <= now and not self._out_of_credits(state, now)
+
+    def available(self):
+        with self.lock:
+            now = time.monotonic()
+            return any(self._in_rotation(state, now) for state in self.states.values())
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                candidates = [state for state in self.states.values() if self._in_rotation(state, now)]
+                if not candidates:
+                    # Every key is out of rotation. Wait for the first throttled one to cool
+                    # down rather than spend a request that is sure to get another 429; if
+                    # only keys out of credits are left, send anyway so the caller gets the
+                    # 402 instead of waiting for credit_cooldown.
+                    throttled = [state for state in self.states.values()
+                                 if not self._out_of_credits(state, now)]
+                    if throttled:
+                        wait = min(state.cooldown_until for state in throttled) - now
+                    else:
+                        wait = 0
+                        candidates = list(self.states.values())
+                if candidates:
+                    state = min(candidates, key=lambda state: (state.in_flight, state.requests))
+                    state.in_flight += 1
+                    state.requests += 1
+                    return state.key
+            time.sleep(wait)
+
+    def release(self, key, status_code, seconds, retry_after=None):
+        # status_code is None when the request never got a response
+        with self.lock:
+            state = self.states[key]
+            state.in_flight -= 1
+            state.seconds += seconds
+            if status_code == 200:
+                state.successes += 1
+                if state.credits is not None and state.credits <= self.min_credits:
+                    # It was topped up since; the balance is unknown until the next refresh
+                    state.credits = None
+            elif status_code == 429:
+                state.throttled += 1
+                state.cooldown_until = time.monotonic() + (retry_after if retry_after is not None else self.cooldown)
+            else:
+                state.failures += 1
+                if status_code == 402:
+                    # Payment required: the account has run out of credits
+                    state.credits = 0
+                    state.credits_retry_at = time.monotonic() + self.credit_cooldown
+
+    def set_credits(self, key, credits):
+        with self.lock:
+            state = self.states[key]
+            state.credits = credits
+            if credits <= self.min_credits:
+                state.credits_retry_at = time.monotonic() + self.credit_cooldown
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            minutes = max(now - self.created_at, 1e-9) / 60
+            stats = []
+            for state in self.states.values():
+                completed = state.successes + state.throttled + state.failures
+                stats.append({
+                    "key": state.label,
+                    "in_rotation": self._in_rotation(state, now),
+                    "in_flight": state.in_flight,
+                    "requests": state.requests,
+                    "successes": state.successes,
+                    "throttled": state.throttled,
+                    "failures": state.failures,
+                    "successes_per_minute": state.successes / minutes,
+                    "mean_seconds": state.seconds / completed if completed else None,
+                    "credits": state.credits,
+                    "cooldown_seconds": max(0.0, state.cooldown_until - now),
+                })
+            return stats
@@ -0,0 +1,187 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Modes: "off" records nothing, "minimal" keeps only in-memory counters, gauges and histograms
+# (a lock and a bisect per observation, safe to leave on in production), "full" also
+# appends every observation to a JSONL log
+OFF = "off"
+MINIMAL = "minimal"
+FULL = "full"
+
+# Latency buckets in seconds, from mask building (ms) to slow upstream calls (minutes)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class MetricsRegistry:
+    def __init__(self, mode=MINIMAL, log_path=None, buckets=DEFAULT_BUCKETS):
+        self.mode = mode
+        self.log_path = log_path
+        self.buckets = buckets
+        self.counters = {}    # name -> {label_key: value}
+        self.histograms = {}  # name -> {label_key: Histogram}
+        self.gauges = {}      # name -> {label_key: value}
+        self.lock = threading.Lock()
+        self._log_file = None
+
+    @property
+    def enabled(self):
+        return self.mode != OFF
+
+    def _log(self, kind, name, value, labels):
+        if self.mode != FULL or not self.log_path:
+            return
+        record = {"ts": time.time(), "kind": kind, "name": name, "value": value, **labels}
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            if self._log_file is None:
+                self._log_file = open(self.log_path, "a", buffering=1)
+            self._log_file.write(line)
+
+    def inc(self, name, amount=1, **labels):
+        if self.mode == OFF:
+            return
+        key = _label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+        self._log("counter", name, amount, labels)
+
+    def set(self, name, value, **labels):
+        # Gauge: the latest value wins, e.g. remaining credits
+        if self.mode == OFF:
+            return
+        key = _label_key(labels)
+        with self.lock:
+            self.gauges.setdefault(name, {})[key] = value
+        self._log("gauge", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        if self.mode == OFF:
+            return
+        key = _label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(value)
+        self._log("histogram", name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        if self.mode == OFF:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def stage(self, stage):
+        # Time one step of the generation pipeline under a shared histogram
+        return self.timer("stage_seconds", stage=stage)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+                "gauges": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self.gauges.items()
+                },
+                "histograms": {
+                    name: [
+                        {"labels": dict(key), "count": histogram.count, "sum": histogram.sum,
+                         "buckets": dict(zip([*map(str, histogram.buckets), "+Inf"], histogram.counts))}
+                        for key, histogram in series.items()
+                    ]
+                    for name, series in self.histograms.items()
+                },
+            }
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {name} gauge")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip([*map(str, histogram.buckets), "+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # Atomic replace so a node-exporter textfile collector never reads half a file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def export_textfile(self, path, interval=15):
+        # Rewrite the Prometheus text at `path` every `interval` seconds on a daemon
+        # thread, e.g. for a node-exporter textfile collector
+        def loop():
+            while True:
+                self.write_prometheus(path)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=loop, name="metrics-export", daemon=True)
+        thread.start()
+        return thread
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+
+# Process-wide registry, configured through METRICS_MODE and METRICS_LOG; the app also
+# reads METRICS_TEXTFILE and SHOW_METRICS
+registry = MetricsRegistry(
+    mode=os.environ.get("METRICS_MODE", MINIMAL),
+    log_path=os.environ.get("METRICS_LOG"),
+)
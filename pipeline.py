@@ -0,0 +1,193 @@
+# Declarative multi-step generation over StabilityAIClient, e.g. refreshing the floor and
+# walls, then adding furniture:
+#
+#   pipeline = Pipeline(client, [
+#       SearchAndReplace(PREPROCESS_PROMPT, PREPROCESS_NEGATIVE_PROMPT),
+#       Structure(prompt, negative_prompt),
+#   ])
+#   result = pipeline.run(image)
+#   variants = pipeline.run_branches(image, {
+#       "Sofa": [Inpaint(sofa_prompt, sofa_negative_prompt, mask)],
+#       "Ground Rug": [Inpaint(rug_prompt, rug_negative_prompt, mask)],
+#   })
+#
+# Each step's output bytes are uploaded as the next step's input exactly as received, with
+# no decode/re-encode in between.
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from api_client import GenerationResult
+from image_codec import encode_image
+
+
+def _mask_bytes(mask):
+    # Masks are encoded once per step, however many times the step runs
+    if isinstance(mask, Image.Image):
+        return encode_image(mask, "png")
+    if isinstance(mask, (str, os.PathLike)):
+        with open(mask, "rb") as file:
+            return file.read()
+    return bytes(mask)
+
+
+class Step:
+    # One generation call. params() identify the step for caching; run() receives the
+    # previous step's output (or the pipeline input) as encoded bytes.
+    name = None
+
+    def params(self):
+        raise NotImplementedError
+
+    def run(self, client, image):
+        raise NotImplementedError
+
+    def cache_key(self, input_key):
+        identity = json.dumps([input_key, self.name, self.params()], sort_keys=True)
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+
+class SearchAndReplace(Step):
+    name = "search_and_replace"
+
+    def __init__(self, prompt, negative_prompt):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+
+    def params(self):
+        return {"prompt": self.prompt, "negative_prompt": self.negative_prompt}
+
+    def run(self, client, image):
+        return client.search_and_replace_image(self.prompt, self.negative_prompt, image)
+
+
+class Structure(Step):
+    name = "structure"
+
+    def __init__(self, prompt, negative_prompt, output_format="png", seed=None):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.output_format = output_format
+        self.seed = seed
+
+    def params(self):
+        return {"prompt": self.prompt, "negative_prompt": self.negative_prompt,
+                "output_format": self.output_format, "seed": self.seed}
+
+    def run(self, client, image):
+        return client.structure_image(self.prompt, self.negative_prompt, image,
+                                      output_format=self.output_format, seed=self.seed)
+
+
+class Inpaint(Step):
+    name = "inpaint"
+
+    def __init__(self, prompt, negative_prompt, mask, output_format="png", seed=None, grow_mask=1):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.mask = _mask_bytes(mask)
+        self.mask_digest = hashlib.sha256(self.mask).hexdigest()
+        self.output_format = output_format
+        self.seed = seed
+        self.grow_mask = grow_mask
+
+    def params(self):
+        return {"prompt": self.prompt, "negative_prompt": self.negative_prompt, "mask": self.mask_digest,
+                "output_format": self.output_format, "seed": self.seed, "grow_mask": self.grow_mask}
+
+    def run(self, client, image):
+        return client.inpaint_image(self.prompt, self.negative_prompt, image, self.mask,
+                                    output_format=self.output_format, seed=self.seed, grow_mask=self.grow_mask)
+
+
+class Erase(Step):
+    name = "erase"
+
+    def __init__(self, prompt, negative_prompt, mask, output_format="png", seed=None, grow_mask=None):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.mask = _mask_bytes(mask)
+        self.mask_digest = hashlib.sha256(self.mask).hexdigest()
+        self.output_format = output_format
+        self.seed = seed
+        self.grow_mask = grow_mask
+
+    def params(self):
+        return {"prompt": self.prompt, "negative_prompt": self.negative_prompt, "mask": self.mask_digest,
+                "output_format": self.output_format, "seed": self.seed, "grow_mask": self.grow_mask}
+
+    def run(self, client, image):
+        return client.erase_image(self.prompt, self.negative_prompt, image, self.mask,
+                                  output_format=self.output_format, seed=self.seed, grow_mask=self.grow_mask)
+
+
+class Pipeline:
+    # Ordered steps run against one client. With a cache (a ResultCache) every step's output
+    # is stored under a key chained from the input image and the steps up to and including
+    # it, so editing a later step reruns only that step and the ones after it. Without one,
+    # unchanged steps are still answered by the client's own result cache if it has one,
+    # since their uploads are byte-identical.
+    def __init__(self, client, steps, cache=None, max_workers=4):
+        self.client = client
+        self.steps = list(steps)
+        self.cache = cache
+        self.max_workers = max_workers
+
+    def _input(self, image):
+        if isinstance(image, Image.Image):
+            content = self.client.encode(image)
+        elif isinstance(image, (str, os.PathLike)):
+            with open(image, "rb") as file:
+                content = file.read()
+        else:
+            content = bytes(image)
+        return content, hashlib.sha256(content).hexdigest()
+
+    def _run_steps(self, steps, content, key):
+        # Returns the last step's result and cache key; a failed step's result is returned
+        # as is and the steps after it are skipped
+        result = None
+        for step in steps:
+            key = step.cache_key(key)
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                self.client.metrics.inc("pipeline_steps_total", step=step.name, result="cache_hit")
+                result = GenerationResult.from_bytes(cached)
+            else:
+                with self.client.metrics.stage(f"pipeline_{step.name}"):
+                    result = step.run(self.client, content)
+                if result.status_code != 200:
+                    self.client.metrics.inc("pipeline_steps_total", step=step.name, result="failed")
+                    return result, key
+                self.client.metrics.inc("pipeline_steps_total", step=step.name, result="ran")
+                if self.cache is not None:
+                    self.cache.put(key, result.content)
+            content = result.content
+        return result, key
+
+    def run(self, image):
+        # image is a PIL image, encoded bytes or a path; returns the last GenerationResult
+        content, key = self._input(image)
+        result, _ = self._run_steps(self.steps, content, key)
+        return result
+
+    def run_branches(self, image, branches):
+        # Run the pipeline's own steps once, then every branch (name -> list of steps) on
+        # their output concurrently. Returns name -> GenerationResult; if the shared steps
+        # fail, every branch gets that failed result.
+        content, key = self._input(image)
+        if self.steps:
+            shared, key = self._run_steps(self.steps, content, key)
+            if shared.status_code != 200:
+                return {name: shared for name in branches}
+            content = shared.content
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="pipeline") as pool:
+            futures = {
+                name: pool.submit(self._run_steps, steps, content, key)
+                for name, steps in branches.items()
+            }
+            return {name: future.result()[0] for name, future in futures.items()}
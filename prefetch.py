@@ -0,0 +1,88 @@
+import json
+import os
+import tempfile
+import threading
+
+from image_codec import encode_image
+from image_processing import build_mask_from_canvas, crop_to_mask, generate_region
+
+
+class SelectionCounts:
+    # How often each catalogue item has been generated, across every session. Persisted as
+    # JSON so the ranking survives restarts.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self.counts = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.counts = {}
+
+    def record(self, item):
+        with self.lock:
+            self.counts[item] = self.counts.get(item, 0) + 1
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            with os.fdopen(fd, "w") as file:
+                json.dump(self.counts, file)
+            os.replace(tmp_path, self.path)
+
+    def top(self, n, items):
+        # Most selected first; ties keep catalogue order
+        with self.lock:
+            return sorted(items, key=lambda item: -self.counts.get(item, 0))[:n]
+
+
+class PrefetchRegion:
+    # The mask and crop shared by one mask's prefetch jobs. Built off the script thread by
+    # whichever job gets past the delay first, so strokes that are still changing cost
+    # nothing, and never archived. The bytes match what "Generate Image" uploads.
+    def __init__(self, canvas_result, image, dilation=0, feather=0, max_pixels=None):
+        self.canvas_result = canvas_result
+        self.image = image
+        self.dilation = dilation
+        self.feather = feather
+        self.max_pixels = max_pixels
+        self.lock = threading.Lock()
+        self.region = None
+
+    def get(self):
+        with self.lock:
+            if self.region is None:
+                mask_image = build_mask_from_canvas(
+                    self.canvas_result, self.image.size, dilation=self.dilation, feather=self.feather)
+                crop_image, crop_mask, box = crop_to_mask(self.image, mask_image, max_pixels=self.max_pixels)
+                self.region = (mask_image, crop_image, box, encode_image(crop_mask, "png"))
+            return self.region
+
+
+def _refund(budgets):
+    for budget in budgets:
+        budget.refund()
+
+
+def prefetch_region(cancelled, delay, budgets, region, generate_fn, **kwargs):
+    # Runs on the prefetch executor. Waits out `delay` first, then spends only if every
+    # budget (RateLimiters) has a token left. region is a PrefetchRegion.
+    # Returns generate_region's result, or None if cancelled or over budget.
+    if cancelled.wait(delay):
+        return None
+    taken = []
+    for budget in budgets:
+        if not budget.try_acquire():
+            # Over one budget: the tokens already taken from the others go back, so e.g.
+            # the server-wide cap doesn't eat into a session's own allowance
+            _refund(taken)
+            return None
+        taken.append(budget)
+    if cancelled.is_set():
+        _refund(taken)
+        return None
+    mask_image, crop_image, box, crop_mask_bytes = region.get()
+    if cancelled.is_set():
+        _refund(taken)
+        return None
+    return generate_region(generate_fn, region.image, mask_image, box,
+                           image=crop_image, mask=crop_mask_bytes, **kwargs)
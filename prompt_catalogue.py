@@ -0,0 +1,200 @@
+# Item prompts from an external catalogue, for catalogues of thousands of SKU-specific
+# prompts. A catalogue is a JSON file, either {"items": [entry, ...]} or a mapping of
+# name -> entry like prompts.item_prompts, or an SQLite database with a `prompts` table:
+#
+#   CREATE TABLE prompts (name TEXT PRIMARY KEY, prompt TEXT NOT NULL, negative_prompt TEXT,
+#                         category TEXT, style TEXT, room TEXT, keywords TEXT)
+#
+# Entries have a prompt and negative_prompt plus optional category, style, room and
+# keywords (a list, or a comma-separated string in SQLite). Without a catalogue file the
+# built-in prompts.item_prompts are used.
+import bisect
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+FACETS = ("category", "style", "room")
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def _tokens(text):
+    return _TOKEN.findall(text.lower())
+
+
+def _entry(name, fields):
+    keywords = fields.get("keywords") or []
+    if isinstance(keywords, str):
+        keywords = [keyword.strip() for keyword in keywords.split(",") if keyword.strip()]
+    return {
+        "name": name,
+        "prompt": fields["prompt"],
+        "negative_prompt": fields.get("negative_prompt") or "",
+        "category": fields.get("category"),
+        "style": fields.get("style"),
+        "room": fields.get("room"),
+        "keywords": keywords,
+    }
+
+
+def read_entries(path):
+    if path.endswith((".sqlite", ".sqlite3", ".db")):
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute("SELECT * FROM prompts").fetchall()
+        finally:
+            connection.close()
+        return [_entry(row["name"], dict(row)) for row in rows]
+    with open(path) as file:
+        data = json.load(file)
+    if isinstance(data, dict) and isinstance(data.get("items"), list):
+        data = data["items"]
+    if isinstance(data, list):
+        return [_entry(item["name"], item) for item in data]
+    return [_entry(name, fields) for name, fields in data.items()]
+
+
+def builtin_entries():
+    from prompts import item_prompts
+    return [_entry(name, fields) for name, fields in item_prompts.items()]
+
+
+class CatalogueIndex:
+    # Immutable lookup structures for one version of the catalogue; a reload builds a new
+    # one and swaps it in, so readers never see a half-built index
+    def __init__(self, entries):
+        self.entries = {entry["name"]: entry for entry in entries}
+        self.names = sorted(self.entries, key=str.lower)
+        self.rank = {name: position for position, name in enumerate(self.names)}
+        self.facets = {facet: {} for facet in FACETS}
+        token_names = {}
+        for entry in self.entries.values():
+            name = entry["name"]
+            for facet in FACETS:
+                if entry[facet]:
+                    self.facets[facet].setdefault(entry[facet], set()).add(name)
+            for token in set(_tokens(" ".join([name, *entry["keywords"]]))):
+                token_names.setdefault(token, set()).add(name)
+        # Facet values are few, so their words point at the facet's name set instead of
+        # being repeated for every entry
+        self.token_facets = {}
+        for facet, values in self.facets.items():
+            for value, names in values.items():
+                for token in set(_tokens(value)):
+                    self.token_facets.setdefault(token, []).append(names)
+                    token_names.setdefault(token, set())
+        # Sorted tokens make a prefix lookup one bisect plus a short scan
+        self.tokens = sorted(token_names)
+        self.token_names = token_names
+
+    def prefix_matches(self, prefix):
+        matches = set()
+        start = bisect.bisect_left(self.tokens, prefix)
+        for token in self.tokens[start:]:
+            if not token.startswith(prefix):
+                break
+            matches |= self.token_names[token]
+            for names in self.token_facets.get(token, ()):
+                matches |= names
+        return matches
+
+
+class PromptCatalogue:
+    # Loaded on first use and checked for changes at most every reload_interval seconds;
+    # an edited file is picked up without restarting the server. Supports the read-only
+    # mapping interface of prompts.item_prompts (catalogue[name]["prompt"], `in`, keys()).
+    def __init__(self, path=None, reload_interval=2.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self._index = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._reloading = False
+
+    def _source_mtime(self):
+        if not self.path:
+            return None
+        mtimes = [os.path.getmtime(path) for path in (self.path, f"{self.path}-wal") if os.path.exists(path)]
+        return max(mtimes) if mtimes else None
+
+    def _current(self):
+        # The first use loads synchronously; later changes are re-indexed on a background
+        # thread while readers keep the previous version
+        now = time.monotonic()
+        if self._index is not None and now - self._checked_at < self.reload_interval:
+            return self._index
+        with self.lock:
+            if self._index is None:
+                self._checked_at = now
+                self.reload(self._source_mtime())
+            elif now - self._checked_at >= self.reload_interval and not self._reloading:
+                self._checked_at = now
+                mtime = self._source_mtime()
+                if mtime != self._mtime:
+                    self._reloading = True
+                    threading.Thread(target=self._reload_in_background, args=(mtime,), daemon=True).start()
+            return self._index
+
+    def _reload_in_background(self, mtime):
+        try:
+            self.reload(mtime)
+        finally:
+            self._reloading = False
+
+    def reload(self, mtime=None):
+        # A file that is missing or half-written keeps the previous version, or the built-in
+        # prompts if nothing has loaded yet
+        try:
+            entries = read_entries(self.path) if self.path else builtin_entries()
+        except (OSError, ValueError, KeyError, sqlite3.Error):
+            if self._index is not None:
+                return
+            entries = builtin_entries()
+        self._index = CatalogueIndex(entries)
+        self._mtime = mtime if mtime is not None else self._source_mtime()
+
+    def __getitem__(self, name):
+        return self._current().entries[name]
+
+    def __contains__(self, name):
+        return name in self._current().entries
+
+    def __len__(self):
+        return len(self._current().entries)
+
+    def get(self, name, default=None):
+        return self._current().entries.get(name, default)
+
+    def keys(self):
+        return list(self._current().names)
+
+    def facet_values(self, facet):
+        return sorted(self._current().facets[facet])
+
+    def search(self, query="", limit=100, exclude=(), **facets):
+        # Names matching every word of the query as a word prefix (over name, category,
+        # style, room and keywords) and every given facet, e.g. style="Scandinavian"
+        index = self._current()
+        matches = None
+        for facet, value in facets.items():
+            if value:
+                names = index.facets[facet].get(value, set())
+                matches = names if matches is None else matches & names
+        for token in _tokens(query):
+            names = index.prefix_matches(token)
+            matches = names if matches is None else matches & names
+        if matches is None:
+            # No filter: the precomputed order, without touching the rest of the catalogue
+            results = []
+            for name in index.names:
+                if name not in exclude:
+                    results.append(name)
+                    if len(results) == limit:
+                        break
+            return results
+        return sorted((name for name in matches if name not in exclude), key=index.rank.get)[:limit]
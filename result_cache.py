@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    # Content-addressed store for generation results on local disk. Entries are evicted
+    # least-recently-used first once max_bytes is exceeded, and expire after ttl seconds
+    # if set. Recency is tracked in memory; after a restart entries are ordered by write time.
+    def __init__(self, directory="cache", max_bytes=512 * 1024 * 1024, ttl=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (size, stored_at)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load_index(self):
+        found = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name.startswith(".") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_mtime, name, stat.st_size))
+        for stored_at, key, size in sorted(found):
+            self.entries[key] = (size, stored_at)
+            self.total_bytes += size
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def _remove(self, key):
+        size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry[1]):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "rb") as file:
+                    content = file.read()
+            except FileNotFoundError:
+                # Removed behind our back, e.g. by another replica sharing the directory
+                self.entries.pop(key)
+                self.total_bytes -= entry[0]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return content
+
+    def contains(self, key):
+        # Presence check that counts as a use, without reading the entry
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry[1]):
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def put(self, key, content):
+        # content is bytes or a readable binary file, which is copied without loading it whole
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as file:
+            if isinstance(content, (bytes, bytearray, memoryview)):
+                file.write(content)
+            else:
+                shutil.copyfileobj(content, file)
+            size = file.tell()
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        with self.lock:
+            os.replace(tmp_path, self._path(key))
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[0]
+            self.entries[key] = (size, time.time())
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+            }
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from metrics import registry as metrics
+
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+class ResultWriter:
+    # Persists accepted generations on a background thread, so the rerun that accepts one
+    # never waits on disk or encoding. Results are stored exactly as encoded (the snapshot
+    # bytes), named by their sha256 digest, so the same image is written once however
+    # often it is accepted:
+    #
+    #   results/<digest>.png         full resolution, as generated
+    #   results/thumbs/<digest>.webp longest side thumbnail_size, if thumbnail_size is set
+    #   results/webp/<digest>.webp   full resolution WebP, if webp_quality is set
+    def __init__(self, directory="results", thumbnail_size=256, webp_quality=85, max_workers=1):
+        self.directory = directory
+        self.thumbnail_size = thumbnail_size
+        self.webp_quality = webp_quality
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="result-writer")
+        self.lock = threading.Lock()
+        self.pending = {}  # digest -> Future, so a result queued twice is written once
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest, kind="original", extension="png"):
+        if kind == "thumbnail":
+            return os.path.join(self.directory, "thumbs", f"{digest}.webp")
+        if kind == "webp":
+            return os.path.join(self.directory, "webp", f"{digest}.webp")
+        return os.path.join(self.directory, f"{digest}.{extension}")
+
+    def submit(self, digest, data, extension="png"):
+        # data is the encoded image and digest its sha256; returns a Future for the path
+        with self.lock:
+            future = self.pending.get(digest)
+            if future is not None:
+                return future
+            future = self.pool.submit(self._write, digest, data, extension)
+            self.pending[digest] = future
+        # Outside the lock: a future that is already done runs the callback right here
+        future.add_done_callback(lambda future: self._done(digest, future))
+        return future
+
+    def _done(self, digest, future):
+        with self.lock:
+            self.pending.pop(digest, None)
+        if future.exception() is not None:
+            metrics.inc("results_written_total", kind="original", result="failed")
+
+    def _write(self, digest, data, extension):
+        path = self.path(digest, extension=extension)
+        if os.path.exists(path):
+            metrics.inc("results_written_total", kind="original", result="duplicate")
+        else:
+            _write_atomic(path, data)
+            metrics.inc("results_written_total", kind="original", result="written")
+
+        image = None
+        if self.thumbnail_size and not os.path.exists(self.path(digest, "thumbnail")):
+            image = Image.open(BytesIO(data))
+            thumbnail = image.copy()
+            thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            self._save_webp(self.path(digest, "thumbnail"), thumbnail, quality=80)
+            metrics.inc("results_written_total", kind="thumbnail", result="written")
+        if self.webp_quality and not os.path.exists(self.path(digest, "webp")):
+            image = image or Image.open(BytesIO(data))
+            self._save_webp(self.path(digest, "webp"), image, quality=self.webp_quality)
+            metrics.inc("results_written_total", kind="webp", result="written")
+        return path
+
+    def _save_webp(self, path, image, quality):
+        buffer = BytesIO()
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+        _write_atomic(path, buffer.getvalue())
+
+    def read(self, digest, kind="original", extension="png"):
+        # Stored bytes for a download, or None if they haven't been written (yet)
+        try:
+            with open(self.path(digest, kind, extension), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import registry as metrics
+
+
+class BlobStore:
+    # Content-addressed blobs on local (or shared) disk: identical snapshots are stored
+    # once, whichever history entry or user they belong to
+    def __init__(self, directory="session_blobs"):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            # Touch it: a blob stored long ago is referenced afresh, and garbage collection
+            # must give it the same grace period as a new one
+            try:
+                os.utime(path)
+                return digest
+            except FileNotFoundError:
+                pass  # Collected in the meantime; write it again
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        with open(self.path(digest), "rb") as file:
+            return file.read()
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def digests(self):
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if not name.startswith("."):
+                    yield name
+
+    def collect_garbage(self, referenced, min_age=3600):
+        # Drop blobs no session refers to; recent ones are kept in case a session is
+        # between writing a blob and saving the state that references it
+        cutoff = time.time() - min_age
+        removed = 0
+        for digest in list(self.digests()):
+            path = self.path(digest)
+            if digest not in referenced and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+class ImageCache:
+    # Process-wide LRU of decoded images keyed by snapshot digest, so a rerun decodes
+    # the current image only when it is not already resident
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, snapshot):
+        with self.lock:
+            image = self.entries.get(snapshot.digest)
+            if image is not None:
+                self.entries.move_to_end(snapshot.digest)
+                return image
+        image = snapshot.decode()
+        nbytes = image.width * image.height * len(image.getbands())
+        with self.lock:
+            if snapshot.digest not in self.entries:
+                self.entries[snapshot.digest] = image
+                self.total_bytes += nbytes
+                while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.total_bytes -= evicted.width * evicted.height * len(evicted.getbands())
+        return image
+
+
+class SessionBackend:
+    # Persists each session's state as a JSON-serialisable dict; images are referenced
+    # by blob digest, never stored inline
+    def load(self, session_id):
+        raise NotImplementedError
+
+    def save(self, session_id, state):
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def expire(self, max_age):
+        # Delete sessions not saved for max_age seconds; returns how many
+        raise NotImplementedError
+
+    def states(self):
+        raise NotImplementedError
+
+    def referenced_digests(self):
+        digests = set()
+        for state in self.states():
+            digests.update(state.get("digests", []))
+        return digests
+
+
+class SQLiteSessionBackend(SessionBackend):
+    def __init__(self, path="sessions.sqlite3"):
+        self.path = path
+        self.local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions "
+                "(id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        # One connection per thread; Streamlit runs each session's script on its own thread
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def load(self, session_id):
+        row = self._connection().execute(
+            "SELECT state FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, session_id, state):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO sessions (id, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (session_id, json.dumps(state), time.time()),
+            )
+
+    def delete(self, session_id):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def expire(self, max_age):
+        with self._connection() as connection:
+            cursor = connection.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - max_age,))
+            return cursor.rowcount
+
+    def states(self):
+        for (state,) in self._connection().execute("SELECT state FROM sessions"):
+            yield json.loads(state)
+
+
+class FilesystemSessionBackend(SessionBackend):
+    def __init__(self, directory="sessions"):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, session_id):
+        # The id becomes a file name, so it must not be able to name a path
+        if not session_id.isalnum():
+            raise ValueError(f"Invalid session id {session_id!r}")
+        return os.path.join(self.directory, f"{session_id}.json")
+
+    def load(self, session_id):
+        try:
+            with open(self._path(session_id)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, session_id, state):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self._path(session_id))
+
+    def delete(self, session_id):
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def expire(self, max_age):
+        cutoff = time.time() - max_age
+        expired = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".json") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                expired += 1
+        return expired
+
+    def states(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                with open(os.path.join(self.directory, name)) as file:
+                    yield json.load(file)
+
+
+def collect_garbage(backend, blob_store, session_ttl):
+    # Expire abandoned sessions, then drop the blobs no remaining session refers to
+    expired = backend.expire(session_ttl)
+    removed = blob_store.collect_garbage(backend.referenced_digests())
+    metrics.inc("session_gc_removed_total", expired, kind="sessions")
+    metrics.inc("session_gc_removed_total", removed, kind="blobs")
+    return expired, removed
+
+
+def schedule_garbage_collection(backend, blob_store, interval, session_ttl):
+    # Runs collect_garbage every `interval` seconds on a daemon thread, for the life of
+    # the process
+    def loop():
+        while True:
+            try:
+                collect_garbage(backend, blob_store, session_ttl)
+            except Exception:
+                metrics.inc("session_gc_runs_total", result="failed")
+            else:
+                metrics.inc("session_gc_runs_total", result="ok")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name="session-gc", daemon=True)
+    thread.start()
+    return thread